@@ -0,0 +1,122 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import config
+import profiling
+
+
+class ServerBusy(Exception):
+    """请求队列已满"""
+
+
+class _Request(object):
+    __slots__ = ('texts', 'corrector', 'future')
+
+    def __init__(self, texts, corrector):
+        self.texts = texts
+        self.corrector = corrector
+        self.future = Future()
+
+
+class MicroBatcher(object):
+    """
+    微批推理：并发请求进入有界队列，后台线程把max_wait时间内到达的请求合并为一个batch，
+    调用corrector.correct_batch后再按请求拆分结果
+    请求可指定纠错器(如租户视图)，同一batch内按纠错器分组推理
+    """
+
+    def __init__(
+            self,
+            corrector,
+            max_batch_size=config.batch_max_size,
+            max_wait=config.batch_max_wait,
+            max_queue_size=config.batch_max_queue_size,
+    ):
+        self.corrector = corrector
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                    self._thread.start()
+
+    def submit(self, texts, corrector=None):
+        """
+        提交纠错请求
+        :param texts: list, 文本
+        :param corrector: 纠错器, 默认self.corrector
+        :return: Future, 结果为[(corrected_text, details)]
+        """
+        self._ensure_started()
+        request = _Request(list(texts), corrector or self.corrector)
+        try:
+            self.queue.put_nowait(request)
+        except queue.Full:
+            raise ServerBusy('too many pending requests: %d' % self.queue.qsize())
+        return request.future
+
+    def correct(self, texts, timeout=config.request_timeout, corrector=None):
+        """
+        同步纠错，超时后取消尚未开始推理的请求
+        :param texts: list, 文本
+        :param timeout: 超时秒数
+        :param corrector: 纠错器, 默认self.corrector
+        :return: list, [(corrected_text, details)]
+        """
+        future = self.submit(texts, corrector)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        # 跳过已超时取消的请求
+        return [request for request in batch if request.future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if not batch:
+                continue
+            groups = {}
+            for request in batch:
+                groups.setdefault(id(request.corrector), []).append(request)
+            for requests in groups.values():
+                self._run_group(requests)
+
+    @staticmethod
+    def _run_group(batch):
+        texts = [text for request in batch for text in request.texts]
+        try:
+            with profiling.request_scope('batch'), profiling.sampled_profile('batch'):
+                results = batch[0].corrector.correct_batch(texts)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        offset = 0
+        for request in batch:
+            request.future.set_result(results[offset:offset + len(request.texts)])
+            offset += len(request.texts)
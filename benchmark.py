@@ -0,0 +1,475 @@
+"""
+纠错器基准测试
+
+在固定语料上逐个测试纠错器，报告加载耗时、峰值内存、吞吐量、延迟分位数及检错/纠错的P/R/F1，
+结果写为JSON，便于版本间对比
+每个纠错器在独立子进程中运行，加载耗时和峰值内存互不影响
+语料为error_generator生成的JSONL(含标注, 计算准确率)或每行一句的文本(只测速度)
+eg:
+    python error_generator.py flaskproject/test.txt bench.jsonl --seed 1
+    python benchmark.py bench.jsonl --algorithms lm macbert --output bench.json
+    python benchmark.py bench.jsonl --output new.json --compare bench.json
+    python benchmark.py bench.jsonl --algorithms macbert --backends torch torch_int8 onnx
+    python benchmark.py --import-budget 1.0
+    python benchmark.py --snapshot-lookup
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import config
+from correct_corpus import ALGORITHMS, load_corrector
+from corrector_registry import get_rss_bytes
+
+# 可选择推理后端的算法, 见inference_backend
+BACKEND_ALGORITHMS = ('bert', 'macbert')
+# 作为精度基准的后端
+BASELINE_BACKEND = 'torch'
+
+def get_peak_rss_bytes():
+    """
+    取当前进程峰值常驻内存
+    :return: int, 字节数
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+    except ImportError:
+        return 0
+
+
+def load_corpus(path, limit=None):
+    """
+    :param path: JSONL(含wrong, right, errors)或每行一句的文本
+    :param limit: 最多条数
+    :return: list, [{'wrong': str, 'right': str or None, 'errors': list or None}]
+    """
+    corpus = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if limit is not None and len(corpus) >= limit:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                record = json.loads(line)
+                corpus.append({
+                    'wrong': record['wrong'],
+                    'right': record.get('right'),
+                    'errors': [tuple(e) for e in record['errors']] if 'errors' in record else None,
+                })
+            else:
+                corpus.append({'wrong': line, 'right': None, 'errors': None})
+    return corpus
+
+
+def percentiles(values):
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'mean': float(np.mean(values))}
+
+
+def prf(tp, n_pred, n_gold):
+    precision = tp / n_pred if n_pred else 0.0
+    recall = tp / n_gold if n_gold else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {'precision': precision, 'recall': recall, 'f1': f1, 'tp': tp, 'pred': n_pred, 'gold': n_gold}
+
+
+def evaluate(corpus, predictions):
+    """
+    按detail计算检错和纠错的P/R/F1
+    检错: 错误位置(begin, end)一致; 纠错: 位置及正确词一致
+    :param corpus: load_corpus结果
+    :param predictions: list, 各句纠错器返回的details
+    :return: dict or None(语料无标注)
+    """
+    gold_items = [item['errors'] for item in corpus]
+    if any(errors is None for errors in gold_items):
+        return None
+    det_tp = cor_tp = n_pred = n_gold = 0
+    sent_tp = 0
+    for gold, pred in zip(gold_items, predictions):
+        gold_det = {(e[2], e[3]) for e in gold}
+        gold_cor = {(e[2], e[3], e[1]) for e in gold}
+        pred_det = {(e[2], e[3]) for e in pred}
+        pred_cor = {(e[2], e[3], e[1]) for e in pred}
+        det_tp += len(gold_det & pred_det)
+        cor_tp += len(gold_cor & pred_cor)
+        n_pred += len(pred_det)
+        n_gold += len(gold_det)
+        sent_tp += gold_cor == pred_cor
+    return {
+        'detection': prf(det_tp, n_pred, n_gold),
+        'correction': prf(cor_tp, n_pred, n_gold),
+        'sentence_accuracy': sent_tp / len(corpus) if corpus else 0.0,
+    }
+
+
+def bucket_name(length, buckets):
+    for low, high in zip(buckets, buckets[1:] + [None]):
+        if high is None or length < high:
+            return '%d-%s' % (low, high - 1 if high is not None else '')
+    return None
+
+
+def run_benchmark(algorithm, corpus, buckets=config.benchmark_length_buckets, batch_size=0, backend=None):
+    """
+    测试单个纠错器，在当前进程中加载模型
+    :param algorithm: 算法名
+    :param corpus: load_corpus结果
+    :param buckets: 句长分桶的下界
+    :param batch_size: 大于0时另测correct_batch的吞吐量
+    :param backend: 推理后端, 不为None时结果中另含各句的纠错输出, 用于与fp32对比
+    :return: dict
+    """
+    if backend is not None:
+        config.inference_backend = backend
+    rss_before = get_rss_bytes()
+    start = time.perf_counter()
+    corrector = load_corrector(algorithm)
+    load_time = time.perf_counter() - start
+    rss_loaded = get_rss_bytes()
+
+    # 首次调用会初始化切词等资源，不计入延迟
+    start = time.perf_counter()
+    corrector.correct(corpus[0]['wrong'] if corpus else '')
+    warmup_time = time.perf_counter() - start
+
+    latencies = []
+    predictions = []
+    outputs = []
+    start = time.perf_counter()
+    for item in corpus:
+        t = time.perf_counter()
+        corrected, details = corrector.correct(item['wrong'])
+        latencies.append(time.perf_counter() - t)
+        predictions.append(details)
+        outputs.append([corrected, details])
+    total_time = time.perf_counter() - start
+
+    by_bucket = {}
+    for item, latency in zip(corpus, latencies):
+        by_bucket.setdefault(bucket_name(len(item['wrong']), list(buckets)), []).append(latency)
+    result = {
+        'algorithm': algorithm,
+        'sentences': len(corpus),
+        'chars': sum(len(item['wrong']) for item in corpus),
+        'load_time': load_time,
+        'warmup_time': warmup_time,
+        'rss_after_load': rss_loaded,
+        'rss_load_delta': rss_loaded - rss_before,
+        'total_time': total_time,
+        'sentences_per_sec': len(corpus) / total_time if total_time else 0.0,
+        'latency': percentiles(latencies),
+        'buckets': {
+            name: dict(percentiles(values), sentences=len(values),
+                       sentences_per_sec=len(values) / sum(values) if sum(values) else 0.0)
+            for name, values in sorted(by_bucket.items(), key=lambda x: int(x[0].split('-')[0]))
+        },
+        'accuracy': evaluate(corpus, predictions),
+    }
+    if backend is not None:
+        # 实际使用的后端, onnxruntime未安装时退回torch
+        result['backend'] = getattr(corrector, 'backend', None)
+        result['outputs'] = outputs
+    if batch_size > 0 and hasattr(corrector, 'correct_batch'):
+        start = time.perf_counter()
+        for i in range(0, len(corpus), batch_size):
+            corrector.correct_batch([item['wrong'] for item in corpus[i:i + batch_size]])
+        batch_time = time.perf_counter() - start
+        result['batch'] = {
+            'batch_size': batch_size,
+            'total_time': batch_time,
+            'sentences_per_sec': len(corpus) / batch_time if batch_time else 0.0,
+        }
+    # 模型权重按需映射，加载后的RSS偏小，运行后的RSS才是常驻内存
+    result['rss_after_run'] = get_rss_bytes()
+    result['peak_rss'] = get_peak_rss_bytes()
+    return result
+
+
+def _run_in_child(conn, algorithm, corpus, buckets, batch_size, backend):
+    try:
+        conn.send(('ok', run_benchmark(algorithm, corpus, buckets, batch_size, backend)))
+    except Exception as e:
+        conn.send(('error', '%s: %s' % (type(e).__name__, e)))
+    finally:
+        conn.close()
+
+
+def run_isolated(algorithm, corpus, buckets=config.benchmark_length_buckets, batch_size=0, backend=None):
+    """在子进程中测试，返回结果或{'error': ...}"""
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=_run_in_child, args=(child_conn, algorithm, corpus, buckets, batch_size, backend))
+    process.start()
+    child_conn.close()
+    try:
+        status, result = parent_conn.recv()
+    except EOFError:
+        status, result = 'error', 'benchmark process exited with code %s' % process.exitcode
+    process.join()
+    return result if status == 'ok' else {'algorithm': algorithm, 'error': result}
+
+
+def drift(corpus, base_outputs, outputs, max_examples=10):
+    """
+    与fp32基准对比纠错输出
+    :param corpus: load_corpus结果
+    :param base_outputs: 基准后端的[[corrected, details]]
+    :param outputs: 待测后端的[[corrected, details]]
+    :param max_examples: 保留的差异样例数
+    :return: dict, 纠错结果或错误明细不同的句子数及比例
+    """
+    changed = 0
+    examples = []
+    for item, (base_corrected, base_details), (corrected, details) in zip(corpus, base_outputs, outputs):
+        if corrected == base_corrected and details == base_details:
+            continue
+        changed += 1
+        if len(examples) < max_examples:
+            examples.append({'wrong': item['wrong'], 'baseline': base_corrected, 'corrected': corrected,
+                             'baseline_details': base_details, 'details': details})
+    return {
+        'sentences': len(outputs),
+        'changed': changed,
+        'rate': changed / len(outputs) if outputs else 0.0,
+        'examples': examples,
+    }
+
+
+def compare(new, old):
+    """
+    对比两次结果的吞吐量、p95延迟和纠错F1
+    :return: list, 可打印的行
+    """
+    lines = []
+    for name, result in new['results'].items():
+        base = old.get('results', {}).get(name)
+        if not base or 'error' in result or 'error' in base:
+            continue
+        rows = [('sentences/s', result['sentences_per_sec'], base['sentences_per_sec']),
+                ('p95 latency', result['latency']['p95'], base['latency']['p95'])]
+        if result.get('accuracy') and base.get('accuracy'):
+            rows.append(('correction f1', result['accuracy']['correction']['f1'],
+                         base['accuracy']['correction']['f1']))
+        for metric, value, base_value in rows:
+            change = (value - base_value) / base_value * 100 if base_value else 0.0
+            lines.append('%-10s %-14s %12.4f -> %12.4f (%+.1f%%)' % (name, metric, base_value, value, change))
+    return lines
+
+
+# 按需导入的重型依赖，web应用启动时不应导入
+HEAVY_MODULES = ('torch', 'transformers', 'kenlm', 'jieba.posseg', 'pypinyin')
+_IMPORT_SCRIPT = """
+import json, sys, time
+sys.path[:0] = %r
+start = time.perf_counter()
+import %s
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'heavy_modules': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def measure_import_time(module, paths=None):
+    """
+    在新的解释器中测量导入耗时，不预加载模型
+    :param module: 模块名
+    :param paths: 额外的sys.path
+    :return: dict, {'seconds': float, 'heavy_modules': list}
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = [root] + list(paths or [])
+    env = dict(os.environ, CGEC_WARMUP_ALGORITHMS='')
+    output = subprocess.run(
+        [sys.executable, '-c', _IMPORT_SCRIPT % (paths, module, HEAVY_MODULES)],
+        env=env, cwd=root, stdout=subprocess.PIPE, check=True, universal_newlines=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def check_import_budget(budget=config.import_time_budget):
+    """
+    检查web应用的导入耗时是否在预算内
+    :return: (bool, dict)
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    result = measure_import_time('app', [os.path.join(root, 'flaskproject')])
+    result['budget'] = budget
+    return result['seconds'] <= budget, result
+
+
+def benchmark_snapshot_lookup(path=config.word_freq_path, lookups=200000):
+    """
+    对比词频词典从文本和从快照加载的耗时、进程内新分配的内存及单次查找耗时
+    :param path: 词频文件, 需已编译进config.lexicon_snapshot_path
+    :param lookups: 查找次数, 命中与未命中各半
+    :return: dict, 耗时单位为秒, 内存为字节, 查找为每次的微秒数
+    """
+    import random
+    import tracemalloc
+    from lexicon_snapshot import get_snapshot_table, parse_text
+    from lm_detector import Detector
+
+    if get_snapshot_table('word_freq', path) is None:
+        raise ValueError('word_freq is not in the snapshot, run lexicon_snapshot.py first: %s' % path)
+
+    def load(name):
+        if name == 'text':
+            with parse_text():
+                return Detector.load_word_freq_dict(path)
+        return Detector.load_word_freq_dict(path)
+
+    result = {}
+    loaded = {}
+    for name in ('text', 'snapshot'):
+        start = time.perf_counter()
+        loaded[name] = load(name)
+        result[name + '_load'] = time.perf_counter() - start
+        # 单独再加载一次统计分配的内存, tracemalloc会拖慢加载
+        tracemalloc.start()
+        mapping = load(name)
+        result[name + '_alloc'] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del mapping
+
+    rng = random.Random(1)
+    words = rng.sample(list(loaded['text']), min(lookups // 2, len(loaded['text'])))
+    keys = words + [w + '々' for w in words]
+    rng.shuffle(keys)
+    for name, mapping in loaded.items():
+        # 与Detector.word_frequency相同的查找方式
+        get = mapping.get
+        start = time.perf_counter()
+        for key in keys:
+            get(key, 0)
+        result['lookup_us_' + name] = (time.perf_counter() - start) / len(keys) * 1e6
+    result['entries'] = len(loaded['text'])
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark Chinese text correctors')
+    parser.add_argument('corpus', nargs='?', help='JSONL from error_generator.py, or plain text one sentence per line')
+    parser.add_argument('--algorithms', nargs='+', default=sorted(ALGORITHMS), choices=sorted(ALGORITHMS))
+    parser.add_argument('--limit', type=int, default=None, help='use the first N sentences')
+    parser.add_argument('--batch-size', type=int, default=0, help='also measure correct_batch throughput')
+    parser.add_argument('--backends', nargs='+', default=None,
+                        help='inference backends of bert/macbert, e.g. torch torch_int8 onnx, '
+                             'drift is reported against torch')
+    parser.add_argument('--output', default=None, help='write results as JSON')
+    parser.add_argument('--compare', default=None, help='previous JSON result to compare with')
+    parser.add_argument('--import-budget', type=float, nargs='?', const=config.import_time_budget, default=None,
+                        help='check that importing the web app takes at most this many seconds')
+    parser.add_argument('--snapshot-lookup', action='store_true',
+                        help='compare word_freq load time, memory and lookup time of text and snapshot')
+    args = parser.parse_args(argv)
+
+    if args.snapshot_lookup:
+        result = benchmark_snapshot_lookup()
+        print('word_freq entries: %d, load: text %.3fs %.1fMB, snapshot %.3fs %.1fMB' % (
+            result['entries'], result['text_load'], result['text_alloc'] / 2 ** 20,
+            result['snapshot_load'], result['snapshot_alloc'] / 2 ** 20))
+        print('lookup: text dict %.3fus, snapshot %.3fus' % (
+            result['lookup_us_text'], result['lookup_us_snapshot']))
+        if not args.corpus and args.import_budget is None:
+            return result
+    if args.import_budget is not None:
+        ok, result = check_import_budget(args.import_budget)
+        print('App import: %.3fs, budget: %.3fs, heavy modules: %s' % (
+            result['seconds'], result['budget'], ', '.join(result['heavy_modules']) or 'none'))
+        if not ok:
+            sys.exit(1)
+        if not args.corpus:
+            return result
+    if not args.corpus:
+        parser.error('corpus is required')
+
+    corpus = load_corpus(args.corpus, args.limit)
+    if not corpus:
+        # 无句子时延迟分位数为None, 无法报告
+        parser.error('corpus is empty: %s%s' % (args.corpus, ', limit %d' % args.limit if args.limit is not None else ''))
+    with open(args.corpus, 'rb') as f:
+        corpus_sha1 = hashlib.sha1(f.read()).hexdigest()
+    report = {
+        'meta': {
+            'corpus': os.path.abspath(args.corpus),
+            'corpus_sha1': corpus_sha1,
+            'sentences': len(corpus),
+            'length_buckets': list(config.benchmark_length_buckets),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': {},
+    }
+    runs = []
+    for algorithm in args.algorithms:
+        if args.backends and algorithm in BACKEND_ALGORITHMS:
+            # 先测fp32基准
+            backends = [BASELINE_BACKEND] + [b for b in args.backends if b != BASELINE_BACKEND]
+            runs.extend(('%s@%s' % (algorithm, backend), algorithm, backend) for backend in backends)
+        else:
+            runs.append((algorithm, algorithm, None))
+    baselines = {}
+    for name, algorithm, backend in runs:
+        print('Benchmarking: %s, sentences: %d' % (name, len(corpus)))
+        result = run_isolated(algorithm, corpus, config.benchmark_length_buckets, args.batch_size, backend)
+        report['results'][name] = result
+        if 'error' in result:
+            print('%s failed: %s' % (name, result['error']))
+            continue
+        accuracy = result['accuracy']
+        print('%s: load %.2fs, %.1f sentences/s, p50 %.1fms, p95 %.1fms, p99 %.1fms, peak rss %.1fMB%s' % (
+            name, result['load_time'], result['sentences_per_sec'],
+            result['latency']['p50'] * 1000, result['latency']['p95'] * 1000, result['latency']['p99'] * 1000,
+            result['peak_rss'] / 1024 / 1024,
+            ', correction f1 %.4f' % accuracy['correction']['f1'] if accuracy else ''))
+        if backend is None:
+            continue
+        outputs = result.pop('outputs')
+        if result['backend'] != backend:
+            print('%s: backend unavailable, ran with %s' % (name, result['backend']))
+        if backend == BASELINE_BACKEND:
+            baselines[algorithm] = outputs
+        elif algorithm in baselines:
+            result['drift'] = drift(corpus, baselines[algorithm], outputs)
+            print('%s: drift vs %s, %d/%d sentences changed (%.2f%%)' % (
+                name, BASELINE_BACKEND, result['drift']['changed'], result['drift']['sentences'],
+                result['drift']['rate'] * 100))
+            for example in result['drift']['examples'][:3]:
+                print('    %s\n    %s: %s\n    %s: %s' % (
+                    example['wrong'], BASELINE_BACKEND, example['baseline'], backend, example['corrected']))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            for line in compare(report, json.load(f)):
+                print(line)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,40 @@
 import codecs
 import operator
-import os
-import time
 
-import jieba
 import torch
 from pypinyin import lazy_pinyin
-from transformers import pipeline
+from transformers import AutoTokenizer
 
 from utils import is_chinese_string, split_by_sym
+from utils import dir_files, resource_version
 import config
+import profiling
+from inference_backend import load_masked_lm
+from lexicon_snapshot import OverlayMap, get_snapshot_table
 
-device_id = 0 if torch.cuda.is_available() else -1
-
-
-# print(device_id)
+def get_device_id():
+    """取推理设备，有GPU时用0号GPU，否则用CPU(-1)；在创建模型时才探测，不在导入时初始化CUDA"""
+    return 0 if torch.cuda.is_available() else -1
 
 
 class BertCorrector():
-    def __init__(self, device=device_id):
+    def __init__(self, device=None, batch_size=config.bert_batch_size, backend=None):
+        """
+        :param device: gpu device id, -1为CPU, 默认有GPU时用0号GPU
+        :param batch_size: 掩码句子批量推理的batch大小
+        :param backend: 推理后端, 见inference_backend, 默认config.inference_backend
+        """
         self.name = 'bert_corrector'
-        self.model = pipeline(
-            'fill-mask',
-            model=config.bert_model_dir,
-            tokenizer=config.bert_model_dir,
-            device=device,  # gpu device id
+        device_id = get_device_id() if device is None else device
+        self.tokenizer = AutoTokenizer.from_pretrained(config.bert_model_dir)
+        self.model, self.backend = load_masked_lm(
+            config.bert_model_dir,
+            backend,
+            torch.device('cuda:%d' % device_id if device_id >= 0 else 'cpu'),
         )
-        if self.model:
-            self.mask = self.model.tokenizer.mask_token
+        self.mask = self.tokenizer.mask_token
+        # 掩码句子批量推理的batch大小
+        self.batch_size = batch_size
 
         self.initialized_corrector = False
 
@@ -36,12 +43,16 @@ class BertCorrector():
         self.word_freq = None
         self.same_pinyin = None
         self.same_stroke = None
+        self._resource_version = None
 
     @staticmethod
     def load_common_char(path):
         """
         加载常用字集合
         """
+        table = get_snapshot_table('common_char', path)
+        if table is not None:
+            return set(table)
         common_char = set()
         with codecs.open(path, 'r', encoding='utf-8') as f:
             for line in f:
@@ -58,6 +69,9 @@ class BertCorrector():
         """
         加载自定义混淆字典
         """
+        table = get_snapshot_table('custom_confusion', path)
+        if table is not None:
+            return {variant: origin for variant, (origin, _) in table.items()}
         custom_confusion = dict()
         with codecs.open(path, 'r', encoding='utf-8') as f:
             for line in f:
@@ -79,6 +93,9 @@ class BertCorrector():
         """
         加载词频字典
         """
+        table = get_snapshot_table('bert_word_freq', path)
+        if table is not None:
+            return OverlayMap({}, table)
         word_freq = dict()
         with codecs.open(path, 'r', encoding='utf-8') as f:
             for line in f:
@@ -99,6 +116,9 @@ class BertCorrector():
         """
         加载同音字字典
         """
+        table = get_snapshot_table('same_pinyin', path)
+        if table is not None:
+            return table
         same_pinyin = dict()
         with codecs.open(path, 'r', encoding='utf-8') as f:
             for line in f:
@@ -121,6 +141,9 @@ class BertCorrector():
         """
         加载形似字字典
         """
+        table = get_snapshot_table('bert_same_stroke', path)
+        if table is not None:
+            return table
         same_stroke = dict()
         with codecs.open(path, 'r', encoding='utf-8') as f:
             for line in f:
@@ -148,6 +171,18 @@ class BertCorrector():
         if not self.initialized_corrector:
             self._initialize_corrector(self)
 
+    def get_resource_version(self):
+        """
+        取词典及模型的版本号，用于结果缓存
+        :return: str
+        """
+        if self._resource_version is None:
+            self._resource_version = resource_version(
+                [config.common_char_path, config.custom_confusion_path, config.word_freq_path,
+                 config.same_pinyin_path, config.same_stroke_path] + dir_files(config.bert_model_dir),
+                self.backend)
+        return self._resource_version
+
     def get_same_pinyin(self, char):
         """
         取该字的同音字集合
@@ -217,6 +252,7 @@ class BertCorrector():
         # print(confusion)
         return confusion
 
+    @profiling.timed('bert.generate_candidate')
     def generate_candidate(self, word, fragment=1):
         """
         生成该词的word纠错候选集
@@ -235,8 +271,90 @@ class BertCorrector():
         confusion_word_set = set(candidates_1)
         confusion_word_list = [item for item in confusion_word_set if is_chinese_string(item)]
         confusion_sorted = sorted(confusion_word_list, key=lambda k: self.word_frequency(k), reverse=True)
-        return confusion_sorted[:len(confusion_word_list) // fragment + 1]
+        candidates = confusion_sorted[:len(confusion_word_list) // fragment + 1]
+        profiling.observe('bert.candidates', len(candidates))
+        return candidates
+
+    @profiling.timed('bert.fill_mask')
+    def fill_mask_batch(self, sentences, top_k=5):
+        """
+        批量预测掩码位置的候选字，各句子补齐后一次送入BertForMaskedLM
+        :param sentences: list, 每句恰含一个[MASK]
+        :param top_k: 每句取前k个候选
+        :return: list, 与fill-mask pipeline单句结果相同的[{'score', 'token', 'token_str'}], 掩码数不为1的句子为None
+        """
+        tokenizer = self.tokenizer
+        model = self.model
+        results = []
+        for i in range(0, len(sentences), self.batch_size):
+            batch = sentences[i:i + self.batch_size]
+            inputs = tokenizer(batch, padding=True, return_tensors='pt').to(model.device)
+            with torch.no_grad():
+                logits = model(**inputs).logits
+            mask_positions = inputs['input_ids'] == tokenizer.mask_token_id
+            rows, cols = torch.nonzero(mask_positions, as_tuple=True)
+            probs = logits[rows, cols].softmax(dim=-1)
+            values, predictions = probs.topk(top_k)
+            mask_counts = mask_positions.sum(dim=1).tolist()
+            batch_results = [None] * len(batch)
+            for row, _values, _predictions in zip(rows.tolist(), values.tolist(), predictions.tolist()):
+                if mask_counts[row] != 1:
+                    continue
+                batch_results[row] = [{'score': v, 'token': p, 'token_str': tokenizer.decode([p])}
+                                      for v, p in zip(_values, _predictions)]
+            results.extend(batch_results)
+        return results
 
+    def _get_mask_sentences(self, block_unc, idx, has_next):
+        """
+        生成当前位置的三种掩码句子
+        :param block_unc: 已纠正部分 + 未纠正部分
+        :param idx: 当前字位置
+        :param has_next: 是否有下一个字
+        :return: (替换掩码句子, 插入掩码句子, 删除当前字后掩码下一个字的句子)
+        """
+        block_lst_1 = list(block_unc)
+        block_lst_2 = list(block_unc)
+        block_lst_1[idx] = self.mask  # [MASK]替换c，实现换词纠错
+        block_lst_2.insert(idx, '[MASK]')  # c前插入[MASK]，实现缺字纠错
+        sentence_mask_3 = None
+        if has_next:
+            try:
+                block_lst_3 = list(block_unc)
+                del block_lst_3[idx]
+                block_lst_3[idx] = self.mask
+                sentence_mask_3 = ''.join(block_lst_3)
+            except IndexError:
+                pass
+        return ''.join(block_lst_1), ''.join(block_lst_2), sentence_mask_3
+
+    def _prefetch(self, predictions, block_unc, idx, remain):
+        """
+        假设后续字都不需纠正，预先生成后续位置的掩码句子并批量推理
+        :param predictions: dict, 掩码句子 -> 预测结果
+        :param block_unc: 已纠正部分 + 未纠正部分
+        :param idx: 当前字位置
+        :param remain: 当前块剩余未处理的字数
+        :return:
+        """
+        sentences = []
+        for j in range(remain):
+            for sentence in self._get_mask_sentences(block_unc, idx + j, j + 1 < remain):
+                if sentence is not None and sentence not in predictions:
+                    sentences.append(sentence)
+            if len(sentences) >= self.batch_size:
+                break
+        predictions.update(zip(sentences, self.fill_mask_batch(sentences)))
+
+    def _get_predicts(self, sentence, predictions):
+        if sentence not in predictions:
+            predictions[sentence] = self.fill_mask_batch([sentence])[0]
+        predicts = predictions[sentence]
+        if predicts is None:
+            raise ValueError('sentence should contain exactly one mask token: %s' % sentence)
+        return predicts
+
+    @profiling.timed('bert.correct')
     def correct(self, text):
         """
         句子纠错
@@ -252,38 +370,27 @@ class BertCorrector():
         blocks = split_by_sym(text)
         for block, start_idx in blocks:
             block_correct = ''
-            idx = start_idx
-            idx_unc = start_idx
+            idx = 0
+            idx_unc = 0
+            # 掩码句子 -> BERT预测结果，按后续字不需纠正预取，纠正后句子变化则重新预取
+            predictions = {}
             for c in block:
+                block_unc = block_correct + block[idx_unc:]
+                has_next = idx_unc + 1 < len(block)
+                sentence_mask_1, sentence_mask_2, sentence_mask_3 = self._get_mask_sentences(block_unc, idx, has_next)
+                if sentence_mask_1 not in predictions:
+                    self._prefetch(predictions, block_unc, idx, len(block) - idx_unc)
 
-
-                # print(block)
-                # print(block_correct, block[idx_unc:])
-
-
-                block_lst_1 = list(block_correct + block[idx_unc:])
-                block_lst_2 = list(block_correct + block[idx_unc:])
-
-                block_lst_1[idx] = self.mask  # [MASK]替换c，实现换词纠错
-                block_lst_2.insert(idx, '[MASK]')  # c前插入[MASK]，实现缺字纠错
-
-                sentence_mask_1 = ''.join(block_lst_1)
-                sentence_mask_2 = ''.join(block_lst_2)
-                # print(idx)
-                # print(sentence_mask_1)
-                predicts_2 = self.model(sentence_mask_2)
+                predicts_2 = [dict(predict) for predict in self._get_predicts(sentence_mask_2, predictions)]
                 # 更新sentence_mask_2的token_str
                 for predict in predicts_2:
                     predict['token_str'] = predict.get('token_str', '') + c
                     # print(predict)
 
-                predicts = self.model(sentence_mask_1) + predicts_2
-                # print(self.model(sentence_mask_1))
+                predicts = self._get_predicts(sentence_mask_1, predictions) + predicts_2
 
                 bert_candidates = dict()
                 for predict in predicts:
-                    # token_id = predict.get('token', 0)
-                    # token_str = self.model.tokenizer.convert_ids_to_tokens(token_id)
                     token_str = predict.get('token_str', '')
                     score = predict.get('score', 0)
                     if is_chinese_string(token_str):
@@ -294,16 +401,11 @@ class BertCorrector():
                 c_next = ''
                 try:
                     c_next = block[idx_unc + 1]
-                    block_lst_3 = list(block_correct + block[idx_unc:])
-                    del block_lst_3[idx]
-                    block_lst_3[idx] = self.mask
-                    sentence_mask_3 = ''.join(block_lst_3)
-                    for predict in self.model(sentence_mask_3):
+                    for predict in self._get_predicts(sentence_mask_3, predictions):
                         token_str = predict.get('token_str', '')
                         score = predict.get('score', 0)
                         if is_chinese_string(token_str):
                             bert_candidates_next[token_str] = score
-                    # print(sentence_mask_3)
                     # print('下一个字的BERT候选集: ', bert_candidates_next)
                 except:
                     pass
@@ -341,6 +443,14 @@ class BertCorrector():
         err = sorted(err, key=operator.itemgetter(2))
         return text_correct, err
 
+    def correct_batch(self, texts):
+        """
+        批量纠错
+        :param texts: list, 文本
+        :return: list, [(corrected_text, err)]
+        """
+        return [self.correct(text) for text in texts]
+
 
 if __name__ == "__main__":
     bertcorrector = BertCorrector()
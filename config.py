@@ -21,6 +21,18 @@ bert_config_path =os.path.join(pwd_path,  'models/bert_finetuned/bert_config.jso
 
 # macbert
 macbert_model_dir = os.path.join(pwd_path, 'models/macbert/')
+# macbert批量纠错时每个batch补齐后的最大token数
+macbert_max_batch_tokens = 4096
+
+# BERT掩码句子批量推理的batch大小
+bert_batch_size = 32
+
+# BERT/MacBERT推理后端: torch(fp32), torch_int8(动态量化, 仅CPU), onnx(onnxruntime, 仅CPU)
+# 可用环境变量CGEC_INFERENCE_BACKEND覆盖; onnxruntime的线程数, 0为默认
+inference_backend = os.environ.get('CGEC_INFERENCE_BACKEND', 'torch')
+inference_threads = 0
+# 导出的ONNX模型目录，不放在模型目录中，避免改变模型目录的资源版本号
+onnx_cache_dir = os.path.join(pwd_path, 'models/onnx')
 
 
 # 数据集路径
@@ -30,3 +42,54 @@ same_pinyin_path = os.path.join(pwd_path, 'data/same_pinyin.txt')    # 同音字
 same_stroke_path = os.path.join(pwd_path, 'data/same_stroke.txt')    # 形似字
 custom_confusion_path = os.path.join(pwd_path, 'data/custom_confusion.txt')    # 混淆集
 proper_name_path = os.path.join(pwd_path, 'data/proper_nouns.txt')    # 专有名词
+same_pinyin_word_index_path = os.path.join(pwd_path, 'data/same_pinyin_word_index.pkl')    # 同音近邻词索引缓存
+lexicon_snapshot_path = os.path.join(pwd_path, 'data/lexicon.snapshot')    # 词典资源二进制快照
+homophone_index_path = os.path.join(pwd_path, 'data/homophone_index.pkl')    # 同音字索引缓存
+# 租户词典目录，每个租户一个子目录，内含custom_confusion.txt、custom_word_freq.txt
+tenant_dict_dir = os.path.join(pwd_path, 'data/tenants')
+# 检查词典文件变化的间隔秒数，变化后在后台重新加载，0不检查
+reload_interval = 5
+
+# 服务
+# 应用启动时预加载的纠错算法，可用环境变量CGEC_WARMUP_ALGORITHMS覆盖，为空时不预加载
+warmup_algorithms = [name for name in os.environ.get('CGEC_WARMUP_ALGORITHMS', 'lm,macbert').split(',') if name]
+# 微批推理：每批最多文本数、凑批最长等待秒数、排队请求上限
+batch_max_size = 32
+batch_max_wait = 0.01
+batch_max_queue_size = 256
+# 单个API请求超时秒数
+request_timeout = 30
+# 流式纠错：每块行数、在途块数上限
+stream_chunk_lines = 16
+stream_max_pending = 4
+# 编辑器文档会话：会话数上限、过期秒数、后台纠错线程数、长轮询最长等待秒数
+session_max_count = 1000
+session_ttl = 30 * 60
+session_workers = 4
+session_poll_timeout = 30
+
+# 纠错结果缓存：内存中最多条数、过期秒数(0不过期)、多进程共享的SQLite文件(为空不启用)
+result_cache_size = 10000
+result_cache_ttl = 24 * 3600
+result_cache_sqlite_path = ''
+# 共享缓存最多保留的条数, 超出时删除最早写入的条目
+result_cache_sqlite_max_rows = 1000000
+# 每写入多少条清理一次共享缓存中过期和超出条数上限的条目
+result_cache_purge_interval = 1000
+
+# 合成纠错语料：各错误类型权重、每句最多错误数、句子含错误的概率
+error_weights = {'homophone': 0.4, 'stroke': 0.2, 'confusion': 0.2, 'insert': 0.1, 'delete': 0.1}
+error_max_per_sentence = 1
+error_sentence_prob = 1.0
+
+# 基准测试的句长分桶下界
+benchmark_length_buckets = [0, 16, 32, 64, 128]
+# 不预加载模型时导入web应用的耗时上限(秒)
+import_time_budget = 1.0
+
+# 耗时统计：是否记录各阶段耗时(可在运行时开关)、请求剖析采样率、剖析器(cprofile/pyinstrument)、剖析结果目录
+profiling_enabled = False
+profiling_sample_rate = 0.0
+profiler = 'cprofile'
+profiling_dump_dir = os.path.join(pwd_path, 'profiles')
+profiling_recent_requests = 100
@@ -0,0 +1,224 @@
+"""
+大规模语料批量纠错
+
+多进程并行纠错，每个worker进程只加载一次模型，结果按输入顺序写为JSONL，可从断点续跑
+eg:
+    python correct_corpus.py corpus.txt corrected.jsonl --algorithm macbert --workers 4
+    python correct_corpus.py corpus.jsonl corrected.jsonl --format jsonl --field text --resume
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+
+from corrector_registry import load_object
+
+# 算法名 -> 纠错器类, 加载时才导入
+ALGORITHMS = {
+    'lm': 'lm_corrector:LMCorrector',
+    'bert': 'bert_corrector:BertCorrector',
+    'macbert': 'macbert_corrector:MacBertCorrector',
+}
+
+_corrector = None
+
+
+def load_corrector(algorithm):
+    corrector = load_object(ALGORITHMS[algorithm])()
+    for init in ('check_detector_initialized', 'check_corrector_initialized'):
+        if hasattr(corrector, init):
+            getattr(corrector, init)()
+    return corrector
+
+
+def _init_worker(algorithm):
+    global _corrector
+    _corrector = load_corrector(algorithm)
+
+
+def _correct_chunk(texts):
+    return _corrector.correct_batch(texts)
+
+
+def read_records(path, fmt='text', field='text'):
+    """
+    逐行读取语料
+    :param path: 输入文件, '-'为标准输入
+    :param fmt: 'text' 每行一条文本, 'jsonl' 每行一个json对象, 不是对象的行抛出ValueError
+    :param field: jsonl中待纠错文本的字段
+    :return: generator, (record, text)
+    """
+    f = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+    try:
+        for line_no, line in enumerate(f):
+            line = line.rstrip('\r\n')
+            if fmt == 'jsonl':
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError('line %d: expected a JSON object, got %s' % (line_no + 1, type(record).__name__))
+                yield record, record.get(field) or ''
+            else:
+                yield {'line': line_no}, line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def iter_chunks(records, chunk_size, skip=0):
+    """
+    按chunk_size分块，跳过已处理的前skip条
+    :return: generator, [(record, text)]
+    """
+    chunk = []
+    for i, item in enumerate(records):
+        if i < skip:
+            continue
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {'records': 0, 'output_bytes': 0}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, records, output_bytes):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'records': records, 'output_bytes': output_bytes}, f)
+    os.replace(tmp_path, path)
+
+
+def correct_corpus(
+        input_path,
+        output_path,
+        algorithm='macbert',
+        fmt='text',
+        field='text',
+        workers=1,
+        chunk_size=64,
+        resume=False,
+        checkpoint_path=None,
+):
+    """
+    语料批量纠错
+    :param input_path: 输入文件
+    :param output_path: 输出JSONL文件，每行在原记录上增加corrected和errors字段
+    :param algorithm: 'lm', 'bert', 'macbert'
+    :param fmt: 'text' or 'jsonl'
+    :param field: jsonl中待纠错文本的字段
+    :param workers: 进程数，1时在当前进程中纠错
+    :param chunk_size: 每个任务的文本条数，同时是断点的粒度
+    :param resume: 是否从断点续跑，否则删除旧断点重新输出；断点超出输出文件大小时从头开始
+    :param checkpoint_path: 断点文件，默认为output_path + '.ckpt'
+    :return: int, 本次处理的条数
+    """
+    checkpoint_path = checkpoint_path or output_path + '.ckpt'
+    checkpoint = {'records': 0, 'output_bytes': 0}
+    if resume and os.path.exists(output_path):
+        checkpoint = load_checkpoint(checkpoint_path)
+        # 输出文件比断点记录的短(被截断或替换)时断点无效，从头开始
+        if checkpoint['output_bytes'] > os.path.getsize(output_path):
+            print('Checkpoint exceeds output size, restart from record 0: %s' % checkpoint_path)
+            checkpoint = {'records': 0, 'output_bytes': 0}
+    if not checkpoint['records'] and os.path.exists(checkpoint_path):
+        # 不续跑时删除旧断点，避免中断后用旧断点续跑新的输出
+        os.remove(checkpoint_path)
+    done = checkpoint['records']
+    out = open(output_path, 'r+b' if done else 'wb')
+    # 丢弃断点之后未完整写入的输出
+    out.seek(checkpoint['output_bytes'])
+    out.truncate()
+    if done:
+        print('Resume from record: %d' % done)
+
+    chunks = iter_chunks(read_records(input_path, fmt, field), chunk_size, skip=done)
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(algorithm,))
+    else:
+        _init_worker(algorithm)
+
+    count = 0
+    start = time.time()
+    # 限制在途任务数，避免把整个语料读入内存
+    pending = deque()
+    try:
+        while True:
+            while pool is not None and len(pending) < workers * 2:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append((chunk, pool.apply_async(_correct_chunk, ([text for _, text in chunk],))))
+            if pool is not None:
+                if not pending:
+                    break
+                chunk, result = pending.popleft()
+                results = result.get()
+            else:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                results = _correct_chunk([text for _, text in chunk])
+
+            lines = []
+            for (record, text), (corrected, details) in zip(chunk, results):
+                record = dict(record)
+                if fmt == 'text':
+                    record['text'] = text
+                record['corrected'] = corrected
+                record['errors'] = details
+                lines.append(json.dumps(record, ensure_ascii=False) + '\n')
+            out.write(''.join(lines).encode('utf-8'))
+            out.flush()
+            count += len(chunk)
+            save_checkpoint(checkpoint_path, done + count, out.tell())
+            if count % (chunk_size * 100) < len(chunk):
+                print('Corrected: %d, %.1f lines/s' % (done + count, count / (time.time() - start)))
+    finally:
+        out.close()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    print('Done, corrected: %d, total: %d, time: %.2fs' % (count, done + count, time.time() - start))
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Chinese text correction for large corpora')
+    parser.add_argument('input', help='input file, one text per line or JSONL, "-" for stdin')
+    parser.add_argument('output', help='output JSONL file')
+    parser.add_argument('--algorithm', default='macbert', choices=sorted(ALGORITHMS))
+    parser.add_argument('--format', default='text', choices=['text', 'jsonl'])
+    parser.add_argument('--field', default='text', help='text field of JSONL input')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=64, help='texts per task and checkpoint')
+    parser.add_argument('--resume', action='store_true', help='resume from the checkpoint of output')
+    parser.add_argument('--checkpoint', default=None, help='checkpoint file, default OUTPUT.ckpt')
+    args = parser.parse_args(argv)
+    correct_corpus(
+        args.input,
+        args.output,
+        algorithm=args.algorithm,
+        fmt=args.format,
+        field=args.field,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        resume=args.resume,
+        checkpoint_path=args.checkpoint,
+    )
+
+
+if __name__ == "__main__":
+    main()
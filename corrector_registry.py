@@ -0,0 +1,281 @@
+import importlib
+import os
+import re
+import threading
+import time
+
+import config
+
+# 租户ID只允许字母、数字、下划线和短横线，避免拼接目录时越界
+TENANT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def get_rss_bytes():
+    """
+    取当前进程常驻内存(RSS)大小
+    :return: int, 字节数, 无法获取时返回0
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # 非linux平台退化为峰值RSS, macOS单位为字节, 其余为KB
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname().sysname == 'Darwin' else rss * 1024
+    except (ImportError, AttributeError):
+        return 0
+
+
+def get_tenant_paths(tenant_id, tenant_dict_dir=None):
+    """
+    取租户词典文件
+    :param tenant_id: 租户ID
+    :param tenant_dict_dir: 租户词典目录, 默认config.tenant_dict_dir
+    :return: dict, for_tenant的参数, 租户没有词典文件时返回None
+    """
+    if not TENANT_ID_PATTERN.match(tenant_id):
+        raise ValueError('invalid tenant id: %r' % tenant_id)
+    tenant_dir = os.path.join(tenant_dict_dir or config.tenant_dict_dir, tenant_id)
+    paths = {}
+    for name, filename in (('custom_confusion_path', 'custom_confusion.txt'),
+                           ('custom_word_freq_path', 'custom_word_freq.txt')):
+        path = os.path.join(tenant_dir, filename)
+        paths[name] = path if os.path.exists(path) else ''
+    return paths if any(paths.values()) else None
+
+
+def dictionary_signature(corrector):
+    """
+    取纠错器词典文件的签名
+    :return: tuple, 纠错器不支持重新加载词典时返回None
+    """
+    from utils import file_signature
+    get_paths = getattr(corrector, 'dictionary_paths', None)
+    return file_signature(get_paths()) if get_paths else None
+
+
+def load_object(path):
+    """
+    按"模块:属性"导入对象
+    :param path: str, eg: 'lm_corrector:LMCorrector'
+    :return: object
+    """
+    module_name, _, attr = path.partition(':')
+    obj = importlib.import_module(module_name)
+    for name in attr.split('.') if attr else ():
+        obj = getattr(obj, name)
+    return obj
+
+
+class CorrectorRegistry(object):
+    """
+    进程级纠错器注册表：每种算法在每个worker进程中只加载一次，并在请求间共享
+    注册时只记录"模块:类"，首次使用时才导入torch、kenlm等依赖
+    租户视图按(算法, 租户)缓存，共享算法的基础词典，租户词典文件修改后重新派生
+    别名与目标算法共用同一纠错器、租户视图和加载统计
+    词典文件修改后在后台构建新纠错器并原子替换，正在处理的请求继续使用旧纠错器
+    """
+
+    def __init__(self):
+        self._factories = {}
+        # {别名: 算法名}
+        self._aliases = {}
+        self._correctors = {}
+        # {(算法名, 租户ID): (词典文件签名, 派生自的纠错器, 租户视图)}
+        self._tenants = {}
+        # 各算法加载时的词典文件签名
+        self._signatures = {}
+        self._watcher = None
+        self._stats = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, factory):
+        """
+        注册算法
+        :param name: 算法名, eg: 'lm', 'macbert'
+        :param factory: 无参可调用对象, 返回纠错器实例; 或"模块:类"字符串, 首次使用时导入
+        :return:
+        """
+        with self._lock:
+            self._aliases.pop(name, None)
+            self._factories[name] = factory
+            self._locks[name] = threading.Lock()
+
+    def register_alias(self, name, target):
+        """
+        注册算法别名，不单独加载纠错器，也不单独统计加载耗时和内存
+        :param name: 别名, eg: 'lm_macbert'
+        :param target: 已注册的算法名
+        :return:
+        """
+        with self._lock:
+            if target not in self._factories:
+                raise KeyError('unknown algorithm: %s' % target)
+            self._factories.pop(name, None)
+            self._aliases[name] = target
+
+    def resolve(self, name):
+        """
+        取别名对应的算法名，不是别名时原样返回
+        """
+        return self._aliases.get(name, name)
+
+    def names(self):
+        return list(self._factories.keys()) + list(self._aliases.keys())
+
+    def __contains__(self, name):
+        return name in self._factories or name in self._aliases
+
+    def is_loaded(self, name):
+        return self.resolve(name) in self._correctors
+
+    def get(self, name, tenant_id=None):
+        """
+        取纠错器，首次调用时加载
+        :param name: 算法名
+        :param tenant_id: 租户ID, 租户没有词典文件或算法不支持租户词典时返回共享的纠错器
+        :return: 纠错器实例
+        """
+        name = self.resolve(name)
+        if tenant_id:
+            return self._get_tenant(name, tenant_id)
+        corrector = self._correctors.get(name)
+        if corrector is not None:
+            return corrector
+        if name not in self._factories:
+            raise KeyError('unknown algorithm: %s' % name)
+        # 同一算法并发请求只加载一次
+        with self._locks[name]:
+            corrector = self._correctors.get(name)
+            if corrector is None:
+                corrector = self._load(name)
+        return corrector
+
+    def _get_tenant(self, name, tenant_id):
+        from utils import file_signature
+        paths = get_tenant_paths(tenant_id)
+        corrector = self.get(name)
+        if paths is None or not hasattr(corrector, 'for_tenant'):
+            return corrector
+        key = (name, tenant_id)
+        signature = file_signature(paths.values())
+        item = self._tenants.get(key)
+        if item is not None and item[0] == signature and item[1] is corrector:
+            return item[2]
+        with self._locks[name]:
+            item = self._tenants.get(key)
+            if item is None or item[0] != signature or item[1] is not corrector:
+                item = self._tenants[key] = (signature, corrector, corrector.for_tenant(tenant_id, **paths))
+        return item[2]
+
+    def _load(self, name):
+        rss_before = get_rss_bytes()
+        start = time.time()
+        factory = self._factories[name]
+        if isinstance(factory, str):
+            factory = load_object(factory)
+        corrector = factory()
+        signature = dictionary_signature(corrector)
+        # 统计语言模型等资源在首次使用时才初始化，这里一并完成
+        for init in ('check_detector_initialized', 'check_corrector_initialized'):
+            if hasattr(corrector, init):
+                getattr(corrector, init)()
+        load_time = time.time() - start
+        rss_delta = get_rss_bytes() - rss_before
+        self._stats[name] = {
+            'load_time': load_time,
+            'rss_delta': rss_delta,
+            'loaded_at': time.time(),
+            'pid': os.getpid(),
+        }
+        self._signatures[name] = signature
+        self._correctors[name] = corrector
+        print('Loaded corrector: %s, time: %.2fs, memory: %.1fMB' % (name, load_time, rss_delta / 1024 / 1024))
+        return corrector
+
+    def reload(self, names=None, only_changed=False):
+        """
+        重新加载词典：新纠错器构建完成后替换注册表中的纠错器，
+        已取得旧纠错器的请求不受影响，多个算法名指向同一纠错器时只构建一次
+        :param names: list, 默认全部已加载算法
+        :param only_changed: 是否只重新加载词典文件有变化的算法
+        :return: list, 重新加载的算法名
+        """
+        rebuilt = {}
+        reloaded = []
+        for name in list(self._correctors) if names is None else names:
+            name = self.resolve(name)
+            if name not in self._correctors or name in reloaded:
+                continue
+            with self._locks[name]:
+                # 加锁后再取，并发的重新加载只构建一次
+                corrector = self._correctors[name]
+                item = rebuilt.get(id(corrector))
+                if item is None:
+                    signature = dictionary_signature(corrector)
+                    if signature is None or not hasattr(corrector, 'reloaded'):
+                        continue
+                    if only_changed and signature == self._signatures.get(name):
+                        continue
+                    item = rebuilt[id(corrector)] = (signature, corrector.reloaded())
+                self._signatures[name] = item[0]
+                self._correctors[name] = item[1]
+            self._stats[name]['reloaded_at'] = time.time()
+            reloaded.append(name)
+        if reloaded:
+            print('Reloaded correctors: %s' % ', '.join(reloaded))
+        return reloaded
+
+    def reload_changed(self):
+        """
+        重新加载词典文件有变化的算法
+        :return: list, 重新加载的算法名
+        """
+        changed = [name for name, corrector in list(self._correctors.items())
+                   if dictionary_signature(corrector) != self._signatures.get(name)]
+        return self.reload(changed, only_changed=True) if changed else []
+
+    def start_watching(self, interval=config.reload_interval):
+        """
+        启动后台线程，每隔interval秒检查词典文件，变化后重新加载
+        :param interval: 秒, 0不检查
+        """
+        if interval <= 0 or self._watcher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload_changed()
+                except Exception as e:
+                    print('reload error, %s' % e)
+
+        self._watcher = threading.Thread(target=run, name='dictionary-watcher', daemon=True)
+        self._watcher.start()
+
+    def warm_up(self, names=None):
+        """
+        预加载算法, 在应用启动时调用
+        :param names: list, 默认加载全部已注册算法
+        :return: dict, 各算法加载统计
+        """
+        for name in names if names is not None else self.names():
+            self.get(name)
+        return self.stats()
+
+    def stats(self):
+        """
+        各算法加载耗时(s)和内存增量(bytes)
+        :return: dict
+        """
+        return {
+            'rss': get_rss_bytes(),
+            'correctors': {name: dict(stat) for name, stat in self._stats.items()},
+            'aliases': dict(self._aliases),
+            'tenants': sorted('%s:%s' % key for key in self._tenants),
+        }
@@ -0,0 +1,250 @@
+"""
+文档会话：编辑器实时纠错
+
+会话保存文档每个整句的指纹及纠错结果，文档更新后只对指纹不在上一版本中的句子重新纠错，
+未变化的句子沿用结果并平移错误位置，耗时与修改量相关，与文档长度无关
+更新在后台线程中处理，处理期间到达的多次更新合并为一次，客户端长轮询取得新结果
+eg:
+    store = SessionStore(get_corrector=registry.get, correct_batch=correct_batch)
+    session = store.create('lm')
+    session.update(text='少先队员因该为老人让坐。')
+    state = session.wait(since=0, timeout=30)
+"""
+import hashlib
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from utils import split_by_sentence
+
+# 含汉字、字母或数字的句子才需要纠错
+re_han = re.compile("[\u4E00-\u9Fa5a-zA-Z0-9]")
+
+
+def fingerprint(sentence):
+    return hashlib.blake2b(sentence.encode('utf-8'), digest_size=16).digest()
+
+
+def apply_edits(text, edits):
+    """
+    按顺序应用编辑，每个编辑的位置相对于应用了之前编辑后的文本
+    :param text: str
+    :param edits: list, [{"begin": int, "end": int, "text": str}]
+    :return: str
+    """
+    for edit in edits:
+        if not isinstance(edit, dict):
+            raise ValueError('invalid edit: %r' % (edit,))
+        begin, end, new = edit.get('begin'), edit.get('end'), edit.get('text', '')
+        if not isinstance(begin, int) or not isinstance(end, int) or not isinstance(new, str) \
+                or not 0 <= begin <= end <= len(text):
+            raise ValueError('invalid edit: %r' % (edit,))
+        text = text[:begin] + new + text[end:]
+    return text
+
+
+class VersionConflict(Exception):
+    """增量编辑基于的文本版本不是会话的当前版本"""
+
+
+class DocumentSession(object):
+    def __init__(self, store, session_id, algorithm, tenant_id=None):
+        self.store = store
+        self.session_id = session_id
+        self.algorithm = algorithm
+        self.tenant_id = tenant_id
+        self.text = ''
+        # 文本版本，每次更新加一
+        self.text_version = 0
+        # 结果版本，每次处理完成加一，长轮询据此判断有无新结果
+        self.version = 0
+        self.last_access = time.time()
+        # {句子指纹: (corrected, details)}, details中的位置相对于句首
+        self._results = {}
+        self._resource_version = None
+        self._state = self._make_state('', [], [], 0, 0, None)
+        self._running = False
+        self._cond = threading.Condition()
+
+    def update(self, text=None, edits=None, base_version=None):
+        """
+        更新文档，在后台重新纠错有变化的句子
+        :param text: str, 新的全文
+        :param edits: list, 增量编辑, 见apply_edits
+        :param base_version: int, 增量编辑基于的文本版本, 与当前版本不一致时抛出VersionConflict
+        :return: int, 新的文本版本
+        """
+        with self._cond:
+            if text is None:
+                if base_version is not None and base_version != self.text_version:
+                    raise VersionConflict('text version is %d, not %d' % (self.text_version, base_version))
+                text = apply_edits(self.text, edits or [])
+            self.text = text
+            self.text_version += 1
+            self.last_access = time.time()
+            text_version = self.text_version
+            if not self._running:
+                self._running = True
+                self.store.executor.submit(self._process)
+        return text_version
+
+    def _process(self):
+        try:
+            while True:
+                with self._cond:
+                    if self._state['text_version'] == self.text_version:
+                        return
+                    text, text_version = self.text, self.text_version
+                self._correct(text, text_version)
+        except Exception as e:
+            print('session error, %s: %s' % (self.session_id, e))
+            with self._cond:
+                self._publish(dict(self._state, error=str(e)))
+        finally:
+            with self._cond:
+                self._running = False
+                # 处理结束前到达的更新
+                if self._state['text_version'] != self.text_version and 'error' not in self._state:
+                    self._running = True
+                    self.store.executor.submit(self._process)
+
+    def _correct(self, text, text_version):
+        corrector = self.store.get_corrector(self.algorithm, self.tenant_id)
+        get_version = getattr(corrector, 'get_resource_version', None)
+        resource_version = get_version() if get_version else None
+        # 词典重新加载后旧结果失效
+        old_results = self._results if resource_version == self._resource_version else {}
+
+        sentences = split_by_sentence(text)
+        fingerprints = [fingerprint(sentence) for sentence, _ in sentences]
+        results = {}
+        todo = OrderedDict()
+        for (sentence, _), fp in zip(sentences, fingerprints):
+            if fp in results or fp in todo:
+                continue
+            if fp in old_results:
+                results[fp] = old_results[fp]
+            elif re_han.search(sentence):
+                todo[fp] = sentence
+            else:
+                results[fp] = (sentence, [])
+        if todo:
+            computed = self.store.correct_batch(self.algorithm, corrector, list(todo.values()))
+            for fp, value in zip(todo, computed):
+                results[fp] = value
+
+        corrected = []
+        errors = []
+        changed = []
+        for (sentence, idx), fp in zip(sentences, fingerprints):
+            sentence_corrected, details = results[fp]
+            corrected.append(sentence_corrected)
+            for wrong, right, begin, end in details:
+                errors.append((wrong, right, begin + idx, end + idx))
+            if fp in todo:
+                changed.append((idx, idx + len(sentence)))
+        state = self._make_state(''.join(corrected), errors, changed, len(sentences), len(todo), text_version)
+        with self._cond:
+            self._results = results
+            self._resource_version = resource_version
+            self._publish(state)
+
+    def _make_state(self, corrected, errors, changed, sentences, corrected_sentences, text_version):
+        return {
+            'session_id': self.session_id,
+            'text_version': text_version or 0,
+            'corrected': corrected,
+            'errors': errors,
+            # 本次重新纠错的句子在新文本中的位置
+            'changed': changed,
+            'sentences': sentences,
+            'corrected_sentences': corrected_sentences,
+        }
+
+    def _publish(self, state):
+        self.version += 1
+        state['version'] = self.version
+        self._state = state
+        self._cond.notify_all()
+
+    def wait(self, since=0, timeout=config.session_poll_timeout):
+        """
+        长轮询：等待结果版本大于since
+        :param since: 客户端已有的结果版本
+        :param timeout: 最长等待秒数
+        :return: dict, 当前结果, 超时未更新时也返回当前结果
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.last_access = time.time()
+            while self.version <= since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return dict(self._state, version=self.version, pending=self._running)
+
+
+class SessionStore(object):
+    """
+    进程内的文档会话，超过ttl未访问的会话被清理，会话数超过上限时清理最久未访问的会话
+    """
+
+    def __init__(
+            self,
+            get_corrector,
+            correct_batch,
+            max_sessions=config.session_max_count,
+            ttl=config.session_ttl,
+            workers=config.session_workers,
+    ):
+        """
+        :param get_corrector: 可调用对象, (algorithm, tenant_id) -> 纠错器
+        :param correct_batch: 可调用对象, (algorithm, corrector, texts) -> [(corrected, details)]
+        :param max_sessions: 会话数上限
+        :param ttl: 会话过期秒数
+        :param workers: 后台纠错线程数
+        """
+        self.get_corrector = get_corrector
+        self.correct_batch = correct_batch
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='document-session')
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, algorithm, tenant_id=None):
+        session = DocumentSession(self, uuid.uuid4().hex, algorithm, tenant_id)
+        with self._lock:
+            self._purge()
+            self._sessions[session.session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def get(self, session_id):
+        """
+        :return: DocumentSession or None
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session.last_access = time.time()
+        return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _purge(self):
+        expire = time.time() - self.ttl
+        for session_id in [k for k, session in self._sessions.items() if session.last_access < expire]:
+            del self._sessions[session_id]
+
+    def __len__(self):
+        return len(self._sessions)
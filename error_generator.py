@@ -0,0 +1,262 @@
+"""
+合成纠错语料
+
+对正确句子随机加入同音字、形似字、混淆集、多字、少字错误，输出错误句及标注
+标注格式与纠错器返回的details一致: (错误词, 正确词, 在错误句中的开始位置, 结束位置)
+多字错误的正确词为空串，少字错误的错误词为空串且开始位置等于结束位置
+eg:
+    python error_generator.py corpus.txt errors.jsonl --seed 1 --workers 4 --max-errors 2
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+import time
+from collections import deque
+
+import config
+from lexicon_snapshot import load_same_stroke, load_set_file
+from pinyin_index import get_homophone_index
+from utils import WordTrie, is_chinese_char
+
+ERROR_TYPES = ('homophone', 'stroke', 'confusion', 'insert', 'delete')
+
+
+class ErrorGenerator(object):
+    def __init__(
+            self,
+            weights=None,
+            max_errors=config.error_max_per_sentence,
+            error_prob=config.error_sentence_prob,
+            common_char_path=config.common_char_path,
+            same_stroke_path=config.same_stroke_path,
+            custom_confusion_path=config.custom_confusion_path,
+    ):
+        """
+        :param weights: dict, 各错误类型的权重, 默认config.error_weights
+        :param max_errors: 每句最多错误数
+        :param error_prob: 句子含错误的概率, 其余句子原样输出, 用于评估误报
+        """
+        self.weights = dict(config.error_weights if weights is None else weights)
+        self.max_errors = max_errors
+        self.error_prob = error_prob
+        # 替换和插入只用常用字，避免生成生僻字
+        self.common_char = load_set_file(common_char_path)
+        self.same_stroke = load_same_stroke(same_stroke_path)
+        self.homophone_index = get_homophone_index()
+        # 混淆集 {纠正: [易错]}, 在正确句中找到纠正词后替换为易错词
+        self.confusion = {}
+        for variant, origin in self._load_confusion(custom_confusion_path):
+            self.confusion.setdefault(origin, []).append(variant)
+        self.confusion_trie = WordTrie(self.confusion.keys())
+        self._homophones = {}
+        self._similar_strokes = {}
+        self._common_chars = sorted(c for c in self.common_char if len(c) == 1)
+
+    @staticmethod
+    def _load_confusion(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('#'):
+                    continue
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] != parts[1]:
+                    yield parts[0], parts[1]
+
+    def get_homophones(self, char):
+        """取不含该字本身的常用同音字"""
+        homophones = self._homophones.get(char)
+        if homophones is None:
+            homophones = self._homophones[char] = sorted(
+                c for c in self.homophone_index.get_homophones(char) if c != char and c in self.common_char)
+        return homophones
+
+    def get_similar_strokes(self, char):
+        """取不含该字本身的常用形似字"""
+        similar = self._similar_strokes.get(char)
+        if similar is None:
+            similar = self._similar_strokes[char] = sorted(
+                c for c in self.same_stroke.get(char, ()) if c != char and c in self.common_char)
+        return similar
+
+    def _candidates(self, error_type, sentence, used):
+        """
+        取某类错误可用的编辑
+        :return: list, [(begin, end, replacement)], 位置为正确句中的位置
+        """
+        free = [i for i, c in enumerate(sentence) if i not in used and is_chinese_char(c)]
+        if error_type == 'homophone':
+            return [(i, i + 1, self.get_homophones) for i in free if self.get_homophones(sentence[i])]
+        if error_type == 'stroke':
+            return [(i, i + 1, self.get_similar_strokes) for i in free if self.get_similar_strokes(sentence[i])]
+        if error_type == 'confusion':
+            edits = []
+            for begin, word in zip(*self.confusion_trie.fmm(sentence)):
+                if not used.intersection(range(begin, begin + len(word))):
+                    edits.append((begin, begin + len(word), self.confusion[word]))
+            return edits
+        if error_type == 'insert':
+            # 在汉字后插入，插入位置不与其他编辑相邻
+            return [(i + 1, i + 1, None) for i in free if i + 1 not in used]
+        if error_type == 'delete':
+            return [(i, i + 1, '') for i in free]
+        raise ValueError('unknown error type: %s' % error_type)
+
+    def _pick(self, error_type, sentence, begin, end, replacement, rng):
+        if error_type in ('homophone', 'stroke'):
+            return rng.choice(replacement(sentence[begin]))
+        if error_type == 'confusion':
+            return rng.choice(replacement)
+        if error_type == 'insert':
+            # 叠字或随机常用字
+            return sentence[begin - 1] if rng.random() < 0.5 else rng.choice(self._common_chars)
+        return replacement
+
+    def generate(self, sentence, rng=random):
+        """
+        对句子加入随机错误
+        :param sentence: 正确句子
+        :param rng: random.Random, 指定种子可复现
+        :return: (错误句, [(错误词, 正确词, 开始位置, 结束位置)])
+        """
+        if not sentence or rng.random() >= self.error_prob:
+            return sentence, []
+        edits = []
+        used = set()
+        for _ in range(rng.randint(1, self.max_errors)):
+            types = [t for t in ERROR_TYPES if self.weights.get(t, 0) > 0]
+            while types:
+                error_type = rng.choices(types, weights=[self.weights[t] for t in types])[0]
+                candidates = self._candidates(error_type, sentence, used)
+                if not candidates:
+                    types.remove(error_type)
+                    continue
+                begin, end, replacement = rng.choice(candidates)
+                edits.append((begin, end, self._pick(error_type, sentence, begin, end, replacement, rng)))
+                # 插入位置前后的字不再编辑，保证标注不重叠
+                used.update(range(begin - 1, end + 1) if begin == end else range(begin, end))
+                break
+            else:
+                break
+
+        # 按正确句中的位置依次拼接，换算为错误句中的位置
+        edits.sort()
+        parts = []
+        details = []
+        cursor = 0
+        shift = 0
+        for begin, end, replacement in edits:
+            parts.append(sentence[cursor:begin])
+            parts.append(replacement)
+            details.append((replacement, sentence[begin:end], begin + shift, begin + shift + len(replacement)))
+            shift += len(replacement) - (end - begin)
+            cursor = end
+        parts.append(sentence[cursor:])
+        return ''.join(parts), details
+
+
+_generator = None
+
+
+def _init_worker(kwargs):
+    global _generator
+    _generator = ErrorGenerator(**kwargs)
+
+
+def _generate_chunk(args):
+    seed, chunk_idx, sentences = args
+    # 每个分块独立的随机数，结果与进程数无关
+    rng = random.Random('%s:%d' % (seed, chunk_idx))
+    return [_generator.generate(sentence, rng) for sentence in sentences]
+
+
+def generate_corpus(sentences, seed=0, workers=1, chunk_size=256, **kwargs):
+    """
+    并行生成纠错语料，按输入顺序输出
+    :param sentences: iterable, 正确句子
+    :param seed: 随机种子，相同种子和chunk_size的结果相同
+    :param workers: 进程数
+    :param chunk_size: 每个任务的句子数
+    :param kwargs: ErrorGenerator参数
+    :return: generator, (正确句, 错误句, details)
+    """
+    def chunks():
+        chunk = []
+        for sentence in sentences:
+            chunk.append(sentence)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    tasks = ((seed, i, chunk) for i, chunk in enumerate(chunks()))
+    if workers <= 1:
+        _init_worker(kwargs)
+        for task in tasks:
+            for sentence, (wrong, details) in zip(task[2], _generate_chunk(task)):
+                yield sentence, wrong, details
+        return
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(kwargs,))
+    # 限制在途任务数，避免把整个语料读入内存
+    pending = deque()
+    try:
+        while True:
+            while len(pending) < workers * 2:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                pending.append((task[2], pool.apply_async(_generate_chunk, (task,))))
+            if not pending:
+                break
+            chunk, result = pending.popleft()
+            for sentence, (wrong, details) in zip(chunk, result.get()):
+                yield sentence, wrong, details
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic Chinese spelling error corpus')
+    parser.add_argument('input', help='correct sentences, one per line, "-" for stdin')
+    parser.add_argument('output', help='output JSONL file, "-" for stdout')
+    parser.add_argument('--seed', default='0')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--max-errors', type=int, default=config.error_max_per_sentence)
+    parser.add_argument('--error-prob', type=float, default=config.error_sentence_prob)
+    parser.add_argument('--weights', default=None,
+                        help='error type weights as JSON, eg: {"homophone": 2, "stroke": 1}')
+    args = parser.parse_args(argv)
+
+    fin = sys.stdin if args.input == '-' else open(args.input, 'r', encoding='utf-8')
+    fout = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    sentences = (line.strip() for line in fin if line.strip())
+    start = time.time()
+    count = 0
+    try:
+        for right, wrong, details in generate_corpus(
+                sentences,
+                seed=args.seed,
+                workers=args.workers,
+                chunk_size=args.chunk_size,
+                weights=json.loads(args.weights) if args.weights else None,
+                max_errors=args.max_errors,
+                error_prob=args.error_prob,
+        ):
+            fout.write(json.dumps({'wrong': wrong, 'right': right, 'errors': details}, ensure_ascii=False) + '\n')
+            count += 1
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+    print('Generated: %d, time: %.2fs' % (count, time.time() - start), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,81 @@
 
+import json
 import re
-from flask import Flask, abort, redirect, render_template, request, current_app
+import threading
+from collections import deque
+from concurrent.futures import TimeoutError
+from itertools import islice
+from flask import Flask, Response, abort, redirect, render_template, request, current_app, jsonify, stream_with_context
 from html import escape
 from werkzeug.exceptions import default_exceptions, HTTPException
-from pypinyin import pinyin, Style
 
-from config import confusion_dic_path
-from lm_corrector import LMCorrector
-from macbert_corrector import MacBertCorrector
-from utils import find_difference, substrings
+import profiling
+from batch_server import MicroBatcher, ServerBusy
+from config import custom_confusion_path, request_timeout, session_poll_timeout, stream_chunk_lines, stream_max_pending
+from config import warmup_algorithms
+from corrector_registry import TENANT_ID_PATTERN, CorrectorRegistry, load_object
+from document_session import SessionStore, VersionConflict
+from result_cache import CachedCorrector, ResultCache
+from utils import file_signature, find_difference, substrings
 
 app = Flask(__name__)
 
+# 纠错结果缓存，各算法共用
+result_cache = ResultCache()
+
+# 算法名 -> 纠错器类，首次使用时才导入，worker启动时不加载torch、kenlm等依赖
+algorithms = {
+    "lm": "lm_corrector:LMCorrector",
+    "macbert": "macbert_corrector:MacBertCorrector",
+}
+
+
+def cached_factory(name):
+    return lambda: CachedCorrector(load_object(algorithms[name])(), name, result_cache)
+
+
+# 纠错器在进程内只加载一次，各请求共享
+registry = CorrectorRegistry()
+for algorithm_name in algorithms:
+    registry.register(algorithm_name, cached_factory(algorithm_name))
+registry.register_alias("lm_macbert", "lm")
+
+# 各算法的微批推理队列，合并并发API请求
+batchers = {}
+batchers_lock = threading.Lock()
+
+
+def get_batcher(algorithm):
+    # 别名与目标算法共用一个队列
+    algorithm = registry.resolve(algorithm)
+    batcher = batchers.get(algorithm)
+    if batcher is None:
+        with batchers_lock:
+            batcher = batchers.get(algorithm)
+            if batcher is None:
+                batcher = batchers[algorithm] = MicroBatcher(registry.get(algorithm))
+    return batcher
+
+
+def session_correct_batch(algorithm, corrector, texts):
+    return get_batcher(algorithm).correct(texts, corrector=corrector)
+
+
+# 编辑器文档会话，只重新纠错修改过的句子
+sessions = SessionStore(get_corrector=registry.get, correct_batch=session_correct_batch)
+
+
+def get_tenant_id(data=None):
+    """取请求的租户ID：请求头X-Tenant-ID，或表单、JSON中的tenant字段，没有时为None"""
+    tenant_id = request.headers.get("X-Tenant-ID")
+    if not tenant_id:
+        tenant_id = (data or request.form).get("tenant")
+    if not tenant_id:
+        return None
+    if not isinstance(tenant_id, str) or not TENANT_ID_PATTERN.match(tenant_id):
+        abort(400, "invalid tenant")
+    return tenant_id
+
 
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
@@ -49,46 +113,216 @@ def compare():
     else:
         abort(400, "missing file")
 
-    if request.form.get("algorithm") == "lm":
-        corrector = LMCorrector()
-    elif request.form.get("algorithm") == "macbert":
-        corrector = MacBertCorrector()
-    elif request.form.get("algorithm") == "lm_macbert":
-        corrector = LMCorrector()
-    else:
+    algorithm = request.form.get("algorithm")
+    if algorithm not in registry:
         abort(400, "invalid algorithm")
+    corrector = registry.get(algorithm, get_tenant_id())
 
     sentence_lst = file1.strip().split('\n')
     # print(sentence_lst)
     corrected_lst = []
-    highlights1 = ''    # 高亮显示错误
-    for sentence in sentence_lst:
+    highlights1 = []    # 高亮显示错误
+    with profiling.request_scope("correcting"), profiling.sampled_profile("correcting"):
+        results = corrector.correct_batch(sentence_lst)    # 批量纠错
+    for sentence, (corrected, errs) in zip(sentence_lst, results):
         print('\n原句: ' + sentence)
-        corrected, errs = corrector.correct(sentence)    # 得到改正后的句子corrected，错误errs
+        # 得到改正后的句子corrected，错误errs
         
         if errs == []:
             print('正确')
             corrected_lst.append(sentence)
-            highlights1 += sentence
         else:
             print('改正：' + str(corrected) + '\n错误：' + str(errs))
             corrected_lst.append(corrected)
-            highlights1 += escape(sentence[0 : errs[0][2]])
-            for i in range(0,len(errs)):
-                # 开始位置errs[i][2]，结束位置errs[i][3]
-                highlights1 += f"<span>{escape(sentence[errs[i][2] : errs[i][3]])}</span>"
-                if i < len(errs)-1:
-                    highlights1 += escape(sentence[errs[i][3] : errs[i+1][2]])
-                else:
-                    highlights1 += escape(sentence[errs[i][3] : len(sentence)])
-            highlights1 += '\n'
-
-    file2 = '\n'.join(corrected_lst)
-    highlights2 = file2
+        highlights1.append(render_errors(sentence, errs))
+
+    highlights1 = '\n'.join(highlights1)
+    highlights2 = escape('\n'.join(corrected_lst))
 
     return render_template("index.html", file1=highlights1, file2=highlights2)
 
 
+@app.route("/api/session", methods=["POST"])
+def create_session():
+    """创建文档会话，请求体可选: {"algorithm": str, "tenant": str, "text": str}"""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        abort(400, "invalid json")
+    algorithm = data.get("algorithm", "macbert")
+    if algorithm not in registry:
+        abort(400, "invalid algorithm")
+    session = sessions.create(algorithm, get_tenant_id(data))
+    text = data.get("text")
+    if isinstance(text, str):
+        session.update(text=text)
+    return jsonify(session_id=session.session_id, text_version=session.text_version), 201
+
+
+def get_session(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        abort(404, "session not found")
+    return session
+
+
+@app.route("/api/session/<session_id>", methods=["POST"])
+def update_session(session_id):
+    """
+    更新文档，请求体: {"text": str} 全文, 或 {"edits": [{"begin", "end", "text"}], "base_version": int} 增量编辑
+    立即返回新的文本版本，纠错结果用长轮询取得
+    """
+    session = get_session(session_id)
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, "invalid json")
+    text = data.get("text")
+    edits = data.get("edits")
+    if not isinstance(text, str) and not isinstance(edits, list):
+        abort(400, "missing text")
+    try:
+        text_version = session.update(text=text if isinstance(text, str) else None, edits=edits,
+                                      base_version=data.get("base_version"))
+    except VersionConflict:
+        return jsonify(error="version conflict", text_version=session.text_version), 409
+    except ValueError:
+        abort(400, "invalid edit")
+    return jsonify(session_id=session_id, text_version=text_version), 202
+
+
+@app.route("/api/session/<session_id>", methods=["GET"])
+def poll_session(session_id):
+    """长轮询，参数since为客户端已有的结果版本，有新结果或超时后返回全文纠错结果"""
+    session = get_session(session_id)
+    since = request.args.get("since", 0, type=int)
+    timeout = min(request.args.get("timeout", session_poll_timeout, type=float), session_poll_timeout)
+    return jsonify(session.wait(since, timeout))
+
+
+@app.route("/api/session/<session_id>", methods=["DELETE"])
+def delete_session(session_id):
+    if not sessions.delete(session_id):
+        abort(404, "session not found")
+    return jsonify(session_id=session_id)
+
+
+def render_errors(sentence, errs):
+    """
+    原句转义为html，错误用<span>标出
+    :param sentence: 原句
+    :param errs: [(错误词, 正确词, 开始位置, 结束位置)]
+    :return: str
+    """
+    parts = []
+    cursor = 0
+    for err in errs:
+        # 开始位置err[2]，结束位置err[3]
+        parts.append(escape(sentence[cursor:err[2]]))
+        parts.append(f"<span>{escape(sentence[err[2]:err[3]])}</span>")
+        cursor = err[3]
+    parts.append(escape(sentence[cursor:]))
+    return ''.join(parts)
+
+
+def iter_upload_lines(stream):
+    """逐行读取上传文件，不把整个文件读入内存"""
+    for line in stream:
+        # utf-8按行切分后可单独解码
+        yield line.decode("utf-8").rstrip("\r\n")
+
+
+@app.route("/correcting/stream", methods=["POST"])
+def correcting_stream():
+    """
+    流式纠错，请求体为utf-8文本文件，参数algorithm、tenant放在查询串中；也可用/correcting的表单提交text1
+    逐行返回NDJSON: {"line": int, "text": str, "corrected": str, "errors": list, "html": str}，
+    最后一行为 {"done": true, "lines": int} 或 {"error": str, "lines": int}
+    请求体边读边分块送入微批队列，读取、纠错、输出流水进行，在途块数有上限，内存占用与文件大小无关
+    """
+    # multipart上传的文件在视图返回后即被关闭，无法边读边纠错，大文件直接作为请求体上传
+    if request.mimetype in ("multipart/form-data", "application/x-www-form-urlencoded"):
+        if not request.form.get("text1"):
+            abort(400, "missing text")
+        lines = iter(request.form.get("text1").strip().split("\n"))
+        params = request.form
+    else:
+        lines = iter_upload_lines(request.stream)
+        params = request.args
+    algorithm = params.get("algorithm")
+    if algorithm not in registry:
+        abort(400, "invalid algorithm")
+    corrector = registry.get(algorithm, get_tenant_id(params))
+    batcher = get_batcher(algorithm)
+
+    def generate():
+        pending = deque()
+        line_no = 0
+        try:
+            while True:
+                while len(pending) < stream_max_pending:
+                    chunk = list(islice(lines, stream_chunk_lines))
+                    if not chunk:
+                        break
+                    pending.append((chunk, batcher.submit(chunk, corrector)))
+                if not pending:
+                    break
+                chunk, future = pending.popleft()
+                records = []
+                for text, (corrected, errs) in zip(chunk, future.result(timeout=request_timeout)):
+                    records.append(json.dumps({"line": line_no, "text": text, "corrected": corrected, "errors": errs,
+                                               "html": render_errors(text, errs)}, ensure_ascii=False))
+                    line_no += 1
+                yield '\n'.join(records) + '\n'
+            yield json.dumps({"done": True, "lines": line_no}) + '\n'
+        except ServerBusy:
+            yield json.dumps({"error": "server busy", "lines": line_no}) + '\n'
+        except TimeoutError:
+            yield json.dumps({"error": "timeout", "lines": line_no}) + '\n'
+        except UnicodeDecodeError:
+            yield json.dumps({"error": "invalid file", "lines": line_no}) + '\n'
+        except Exception as e:
+            # 纠错器内部错误也要以结束记录收尾，客户端据此判断输出不完整
+            print('stream correct error, %s' % e)
+            yield json.dumps({"error": str(e), "lines": line_no}, ensure_ascii=False) + '\n'
+        finally:
+            # 出错或客户端断开时取消尚未开始推理的块
+            for _, future in pending:
+                future.cancel()
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+@app.route("/api/correct", methods=["POST"])
+def api_correct():
+    """JSON纠错接口，请求体: {"text": str} 或 {"texts": [str]}, 可选 "algorithm", "tenant" """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, "invalid json")
+    texts = data.get("texts")
+    if texts is None and "text" in data:
+        texts = [data["text"]]
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        abort(400, "missing text")
+    algorithm = data.get("algorithm", "macbert")
+    if algorithm not in registry:
+        abort(400, "invalid algorithm")
+    tenant_id = get_tenant_id(data)
+
+    try:
+        # 租户请求与其他请求进入同一队列，推理时按纠错器分组
+        results = get_batcher(algorithm).correct(texts, corrector=registry.get(algorithm, tenant_id))
+    except ServerBusy:
+        return jsonify(error="server busy"), 503, {"Retry-After": "1"}
+    except TimeoutError:
+        return jsonify(error="timeout"), 504
+
+    return jsonify(
+        algorithm=algorithm,
+        tenant=tenant_id,
+        results=[{"text": text, "corrected": corrected, "errors": errs}
+                 for text, (corrected, errs) in zip(texts, results)],
+    )
+
+
 def highlight(s, regexes):
     """高亮显示"""
 
@@ -155,16 +389,72 @@ def highlight(s, regexes):
     return result
 
 
+# 按拼音排好序的混淆集, (文件签名, 列表), 文件变化后才重新排序
+confusion_view = (None, [])
+
+
+def get_sorted_confusion():
+    global confusion_view
+    signature = file_signature([custom_confusion_path])
+    view = confusion_view
+    if view[0] != signature:
+        from pypinyin import pinyin, Style
+        confusion_lst = []
+        for confusion in open(custom_confusion_path, "r", encoding='utf-8'):
+            confusion_lst.append(confusion.split())
+
+        del confusion_lst[0]
+        confusion_lst.sort(key=lambda keys:[pinyin(i, style=Style.TONE3) for i in keys])
+        view = confusion_view = (signature, confusion_lst)
+    return view[1]
+
+
 @app.route("/setting", methods=["GET"])
 def setting():
     """设置"""
-    confusion_lst = []
-    for confusion in open(confusion_dic_path, "r", encoding='utf-8'):
-        confusion_lst.append(confusion.split())
+    return render_template("setting.html", confusion_lst=get_sorted_confusion(), i=1)
+
+
+@app.route("/reload", methods=["POST"])
+def reload():
+    """重新加载词典文件有变化的算法, 请求体可选 {"algorithms": [str]} 强制重新加载"""
+    data = request.get_json(silent=True) or {}
+    names = data.get("algorithms")
+    if names is not None and (not isinstance(names, list) or not all(name in registry for name in names)):
+        abort(400, "invalid algorithm")
+    reloaded = registry.reload(names) if names is not None else registry.reload_changed()
+    return jsonify(reloaded=reloaded)
+
 
-    del confusion_lst[0]
-    confusion_lst.sort(key=lambda keys:[pinyin(i, style=Style.TONE3) for i in keys])
-    return render_template("setting.html", confusion_lst=confusion_lst, i=1)
+@app.route("/status", methods=["GET"])
+def status():
+    """各算法加载耗时、内存占用及结果缓存命中率"""
+    stats = registry.stats()
+    stats["result_cache"] = result_cache.stats()
+    return jsonify(stats)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus格式的各阶段耗时及候选集大小"""
+    return Response(profiling.export_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/profiling", methods=["GET", "POST"])
+def profiling_setting():
+    """查看或切换耗时统计，POST请求体: {"enabled": bool, "sample_rate": float, "reset": bool}"""
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            abort(400, "invalid json")
+        if data.get("reset"):
+            profiling.reset()
+        profiling.set_enabled(data.get("enabled", profiling.enabled), data.get("sample_rate"))
+    return jsonify(
+        enabled=profiling.enabled,
+        sample_rate=profiling.sample_rate,
+        recent_requests=list(profiling.recent_requests),
+    )
 
 
 @app.errorhandler(HTTPException)
@@ -177,5 +467,10 @@ def errorhandler(error):
 for code in default_exceptions:
     app.errorhandler(code)(errorhandler)
 
+# 启动时预加载模型
+registry.warm_up(warmup_algorithms)
+# 词典文件修改后在后台重新加载
+registry.start_watching()
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
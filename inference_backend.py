@@ -0,0 +1,134 @@
+"""
+BERT类掩码语言模型的推理后端，由config.inference_backend选择
+    torch: fp32 PyTorch
+    torch_int8: Linear层动态量化为int8，只在CPU上运行，模型约为fp32的1/3
+    onnx: 导出的ONNX图用onnxruntime在CPU上推理，首次使用时导出到config.onnx_cache_dir
+onnx或onnxruntime未安装、导出或加载失败时退回torch
+各后端的返回值一致: model(input_ids=..., attention_mask=..., token_type_ids=...).logits为torch.Tensor
+与fp32的纠错结果差异用benchmark.py --backends测试
+"""
+import gc
+import hashlib
+import os
+
+import torch
+from transformers import AutoModelForMaskedLM
+from transformers.modeling_outputs import MaskedLMOutput
+
+import config
+
+BACKENDS = ('torch', 'torch_int8', 'onnx')
+ONNX_INPUT_NAMES = ['input_ids', 'attention_mask', 'token_type_ids']
+
+
+class OnnxMaskedLM(object):
+    """onnxruntime推理，接口与BertForMaskedLM一致"""
+
+    def __init__(self, path, threads=config.inference_threads):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [item.name for item in self.session.get_inputs()]
+        self.device = torch.device('cpu')
+
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+    def __call__(self, **inputs):
+        feed = {name: inputs[name].cpu().numpy() for name in self.input_names if name in inputs}
+        logits = self.session.run(['logits'], feed)[0]
+        return MaskedLMOutput(logits=torch.from_numpy(logits))
+
+
+def get_onnx_path(model_dir, cache_dir=None):
+    """
+    ONNX文件路径，按模型目录区分，不写入模型目录
+    :param cache_dir: 默认config.onnx_cache_dir
+    """
+    cache_dir = cache_dir or config.onnx_cache_dir
+    model_dir = os.path.abspath(model_dir)
+    digest = hashlib.sha1(model_dir.encode('utf-8')).hexdigest()[:10]
+    return os.path.join(cache_dir, '%s_%s.onnx' % (os.path.basename(model_dir), digest))
+
+
+def export_onnx(model_dir, path=None):
+    """
+    导出ONNX图，batch和句长为动态维度
+    :param model_dir: 模型目录
+    :param path: 输出文件, 默认见get_onnx_path
+    :return: str, 输出文件
+    """
+    path = path or get_onnx_path(model_dir)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    model = AutoModelForMaskedLM.from_pretrained(model_dir).eval()
+    dummy = torch.ones((1, 8), dtype=torch.long)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                (dummy, dummy, torch.zeros_like(dummy)),
+                tmp_path,
+                input_names=ONNX_INPUT_NAMES,
+                output_names=['logits'],
+                dynamic_axes={name: {0: 'batch', 1: 'sequence'} for name in ONNX_INPUT_NAMES + ['logits']},
+                opset_version=14,
+                dynamo=False,
+            )
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print('Exported onnx model: %s' % path)
+    return path
+
+
+def _is_stale(path, model_dir):
+    """ONNX文件不存在或早于模型权重"""
+    if not os.path.exists(path):
+        return True
+    mtime = os.path.getmtime(path)
+    for name in os.listdir(model_dir):
+        if name.endswith(('.bin', '.safetensors')) and os.path.getmtime(os.path.join(model_dir, name)) > mtime:
+            return True
+    return False
+
+
+def load_masked_lm(model_dir, backend=None, device=None):
+    """
+    加载掩码语言模型
+    :param model_dir: 模型目录
+    :param backend: 'torch', 'torch_int8', 'onnx', 默认config.inference_backend
+    :param device: torch.device, 默认有GPU时用GPU; 量化和ONNX后端只用CPU
+    :return: (model, backend), 可用的后端与指定的不同时返回实际使用的后端
+    """
+    backend = backend or config.inference_backend
+    if backend not in BACKENDS:
+        raise ValueError('unknown inference backend: %s' % backend)
+    if device is None:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if backend == 'onnx':
+        try:
+            # 导出需要onnx, 推理需要onnxruntime
+            import onnx, onnxruntime  # noqa: F401
+            path = get_onnx_path(model_dir)
+            if _is_stale(path, model_dir):
+                export_onnx(model_dir, path)
+            return OnnxMaskedLM(path), backend
+        except Exception as e:
+            # 导出失败、目录不可写、ONNX文件损坏等都退回torch，不影响worker启动
+            print('onnx backend unavailable, fallback to torch, %s: %s' % (type(e).__name__, e))
+            backend = 'torch'
+    model = AutoModelForMaskedLM.from_pretrained(model_dir).eval()
+    if backend == 'torch_int8':
+        # 动态量化只支持CPU
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        # fp32模型有循环引用，立即回收，否则常驻内存比fp32还大
+        gc.collect()
+        return model, backend
+    return model.to(device), backend
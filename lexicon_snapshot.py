@@ -0,0 +1,477 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from collections import ChainMap
+from collections.abc import Mapping
+from zlib import crc32
+
+import config
+
+SNAPSHOT_MAGIC = b'CGECLEX\0'
+SNAPSHOT_VERSION = 1
+_HEADER = struct.Struct('<II')    # version, meta_len
+
+# 资源名 -> (表类型, 默认源文件)
+SNAPSHOT_SOURCES = {
+    'word_freq': ('freq', config.word_freq_path),
+    'common_char': ('set', config.common_char_path),
+    'same_pinyin': ('multi', config.same_pinyin_path),
+    'same_stroke': ('multi', config.same_stroke_path),
+    'custom_confusion': ('confusion', config.custom_confusion_path),
+    # BertCorrector的解析规则不同: 词频忽略单列行, 形似字后出现的行覆盖前面的行
+    'bert_word_freq': ('freq', config.word_freq_path),
+    'bert_same_stroke': ('multi', config.same_stroke_path),
+}
+# 与其他资源共用源文件的资源, 编译时sources按被共用的资源名指定
+SNAPSHOT_SOURCE_ALIASES = {
+    'bert_word_freq': 'word_freq',
+    'bert_same_stroke': 'same_stroke',
+}
+
+
+def _align(n, size=8):
+    return (n + size - 1) // size * size
+
+
+def _source_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+_MISSING = object()
+
+
+class SnapshotTable(Mapping):
+    """
+    快照中的只读字典，按crc32开放寻址哈希查找，键值都在mmap页上，不复制到Python对象
+    各进程共享同一份页缓存，加载时不建dict，也不在fork前由父进程建dict(引用计数写入会使共享页逐步复制)
+    代价是查找比dict慢：35万词时单次约1.5-2us，dict约0.3us，见benchmark.py --snapshot-lookup
+    freq: {word: freq}
+    set: {word: True}
+    multi: {char: frozenset(chars)}
+    confusion: {variant: (origin, freq)}
+    """
+
+    def __init__(self, snapshot, kind, count, arrays):
+        self._snapshot = snapshot
+        self.kind = kind
+        self._count = count
+        self._keys = arrays['keys']
+        self._slots = arrays['slots']
+        self._mask = len(self._slots) - 1
+        self._arrays = arrays
+        self._probe = (self._slots, self._keys, snapshot._offsets, snapshot._mmap, snapshot._data_start, self._mask)
+
+    def _value(self, row):
+        if self.kind == 'freq':
+            return self._arrays['values'][row]
+        if self.kind == 'multi':
+            indptr = self._arrays['indptr']
+            string = self._snapshot.string
+            return frozenset(string(i) for i in self._arrays['values'][indptr[row]:indptr[row + 1]])
+        if self.kind == 'confusion':
+            return self._snapshot.string(self._arrays['values'][row]), self._arrays['freqs'][row]
+        return True
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        # 词频查找的热路径，探测循环写在这里，不再拆出函数调用
+        if not isinstance(key, str):
+            return default
+        data = key.encode('utf-8')
+        size = len(data)
+        slots, keys, offsets, mm, start, mask = self._probe
+        i = crc32(data) & mask
+        row = slots[i]
+        while row:
+            sid = keys[row - 1]
+            begin = start + offsets[sid]
+            # 先比长度，再直接比较mmap切片，比memoryview切片比较快
+            if start + offsets[sid + 1] - begin == size and mm[begin:begin + size] == data:
+                return self._value(row - 1)
+            i = (i + 1) & mask
+            row = slots[i]
+        return default
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        string = self._snapshot.string
+        for row in range(self._count):
+            yield string(self._keys[row])
+
+
+class OverlayMap(ChainMap):
+    """
+    在快照表等只读字典上叠加可写的dict层，写入只落在maps[0]
+    ChainMap的get先逐层判断in再逐层取值，这里每层只查一次
+    """
+
+    def __getitem__(self, key):
+        for mapping in self.maps:
+            value = mapping.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        return self.__missing__(key)
+
+    def get(self, key, default=None):
+        for mapping in self.maps:
+            value = mapping.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        return default
+
+    def __contains__(self, key):
+        for mapping in self.maps:
+            if key in mapping:
+                return True
+        return False
+
+
+class LexiconSnapshot(object):
+    """
+    词典资源二进制快照，内存映射加载，多进程共享页缓存
+    文件布局: magic | version, meta_len | meta(json) | 各数组(8字节对齐)
+    全部字词存于一张字符串表(string_data + string_offsets)，各资源表只存字符串id
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError('not a lexicon snapshot: %s' % path)
+        version, meta_len = _HEADER.unpack_from(self._mmap, len(SNAPSHOT_MAGIC))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('snapshot version %d, expected %d: %s' % (version, SNAPSHOT_VERSION, path))
+        meta_start = len(SNAPSHOT_MAGIC) + _HEADER.size
+        self.meta = json.loads(self._mmap[meta_start:meta_start + meta_len].decode('utf-8'))
+        if self.meta['byteorder'] != sys.byteorder:
+            raise ValueError('snapshot byteorder mismatch: %s' % path)
+        self._base = _align(meta_start + meta_len)
+        self._view = memoryview(self._mmap)
+        self._data = self._array(self.meta['strings']['data'])
+        self._data_start = self._base + self.meta['strings']['data'][1]
+        self._offsets = self._array(self.meta['strings']['offsets'])
+        self._tables = {}
+
+    def _array(self, spec):
+        typecode, offset, length = spec
+        view = self._view[self._base + offset:self._base + offset + length]
+        return view if typecode == 'B' else view.cast(typecode)
+
+    def string(self, sid):
+        return bytes(self._data[self._offsets[sid]:self._offsets[sid + 1]]).decode('utf-8')
+
+    def table(self, name):
+        table = self._tables.get(name)
+        if table is None:
+            section = self.meta['sections'][name]
+            arrays = {key: self._array(spec) for key, spec in section['arrays'].items()}
+            table = self._tables[name] = SnapshotTable(self, section['kind'], section['count'], arrays)
+        return table
+
+    def get_table(self, name, source_path):
+        """
+        取资源表，快照中无此资源、源文件不同或已修改时返回None
+        :param name: 资源名
+        :param source_path: 源文件路径
+        :return: SnapshotTable or None
+        """
+        section = self.meta['sections'].get(name)
+        if not section or not source_path or not os.path.exists(source_path):
+            return None
+        if section['source'] != os.path.abspath(source_path) or section['signature'] != _source_signature(source_path):
+            return None
+        return self.table(name)
+
+
+_parse_local = threading.local()
+
+
+class parse_text(object):
+    """
+    在with块内(当前线程)各加载函数不读快照，直接解析文本文件
+    用于编译快照，以及对比文本和快照的加载、查找耗时, eg:
+        with parse_text():
+            word_freq = Detector.load_word_freq_dict(path)
+    """
+
+    def __enter__(self):
+        self._active = getattr(_parse_local, 'active', False)
+        _parse_local.active = True
+        return self
+
+    def __exit__(self, *args):
+        _parse_local.active = self._active
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def load_snapshot(path=config.lexicon_snapshot_path):
+    """
+    加载快照，进程内只映射一次，文件不存在或无效时返回None
+    """
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    with _snapshots_lock:
+        if path not in _snapshots:
+            snapshot = None
+            if os.path.exists(path):
+                try:
+                    snapshot = LexiconSnapshot(path)
+                except (ValueError, OSError, KeyError) as e:
+                    print('load snapshot error, %s' % e)
+            _snapshots[path] = snapshot
+        return _snapshots[path]
+
+
+def get_snapshot_table(name, source_path, snapshot_path=config.lexicon_snapshot_path):
+    """
+    取与源文件一致的快照资源表，无可用快照时返回None，由调用方解析文本文件
+    """
+    if getattr(_parse_local, 'active', False):
+        return None
+    snapshot = load_snapshot(snapshot_path)
+    if snapshot is None:
+        return None
+    return snapshot.get_table(name, source_path)
+
+
+class _SnapshotWriter(object):
+    def __init__(self):
+        self.strings = {}
+        self.blobs = []
+        self.size = 0
+
+    def intern(self, s):
+        sid = self.strings.get(s)
+        if sid is None:
+            sid = self.strings[s] = len(self.strings)
+        return sid
+
+    def add(self, typecode, values):
+        if typecode == 'B':
+            data = bytes(values)
+        else:
+            data = array(typecode, values).tobytes()
+        offset = _align(self.size)
+        self.blobs.append((offset, data))
+        self.size = offset + len(data)
+        return [typecode, offset, len(data)]
+
+    def add_table(self, kind, items):
+        """
+        :param items: list, [(key, value)]
+        """
+        keys = [self.intern(key) for key, _ in items]
+        slots = [0] * max(8, 1 << (2 * len(keys)).bit_length())
+        mask = len(slots) - 1
+        for row, (key, _) in enumerate(items):
+            i = crc32(key.encode('utf-8')) & mask
+            while slots[i]:
+                i = (i + 1) & mask
+            slots[i] = row + 1
+        arrays = {'keys': self.add('I', keys), 'slots': self.add('I', slots)}
+        if kind == 'freq':
+            arrays['values'] = self.add('q', [value for _, value in items])
+        elif kind == 'multi':
+            indptr, values = [0], []
+            for _, value in items:
+                values.extend(self.intern(v) for v in sorted(value))
+                indptr.append(len(values))
+            arrays['indptr'] = self.add('I', indptr)
+            arrays['values'] = self.add('I', values)
+        elif kind == 'confusion':
+            arrays['values'] = self.add('I', [self.intern(origin) for _, (origin, _) in items])
+            arrays['freqs'] = self.add('q', [freq for _, (_, freq) in items])
+        return {'kind': kind, 'count': len(items), 'arrays': arrays}
+
+    def write(self, path, sections):
+        strings = sorted(self.strings, key=self.strings.get)
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = [0]
+        for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+        meta = {
+            'byteorder': sys.byteorder,
+            'sections': sections,
+            'strings': {
+                'count': len(strings),
+                'data': self.add('B', b''.join(encoded)),
+                'offsets': self.add('I', offsets),
+            },
+        }
+        meta_data = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(_HEADER.pack(SNAPSHOT_VERSION, len(meta_data)))
+            f.write(meta_data)
+            base = _align(f.tell())
+            for offset, data in self.blobs:
+                f.write(b'\0' * (base + offset - f.tell()))
+                f.write(data)
+        os.replace(tmp_path, path)
+
+
+def load_set_file(path):
+    """
+    加载常用字等集合文件，每行一个字词
+    :param path:
+    :return: set
+    """
+    table = get_snapshot_table('common_char', path)
+    if table is not None:
+        return set(table)
+    words = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for w in f:
+            w = w.strip()
+            if w.startswith('#'):
+                continue
+            if w:
+                words.add(w)
+    return words
+
+
+def load_same_pinyin(path, sep='\t'):
+    """
+    加载同音字，文件不存在时由同音字索引生成
+    :param path:
+    :param sep:
+    :return: dict, {char: set(chars)}
+    """
+    table = get_snapshot_table('same_pinyin', path)
+    if table is not None:
+        return table
+    result = dict()
+    if not os.path.exists(path):
+        print("file not exists:" + path)
+        from pinyin_index import get_homophone_index
+        return get_homophone_index().same_pinyin_dict()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#'):
+                continue
+            parts = line.split(sep)
+            if parts and len(parts) > 2:
+                key_char = parts[0]
+                same_pron_same_tone = set(list(parts[1]))
+                same_pron_diff_tone = set(list(parts[2]))
+                value = same_pron_same_tone.union(same_pron_diff_tone)
+                if key_char and value:
+                    result[key_char] = value
+    return result
+
+
+def load_same_stroke(path, sep='\t'):
+    """
+    加载形似字，同一行的字互为形似字，一个字出现在多行时取并集
+    :param path:
+    :param sep:
+    :return: dict, {char: set(chars)}
+    """
+    table = get_snapshot_table('same_stroke', path)
+    if table is not None:
+        return table
+    result = dict()
+    if not os.path.exists(path):
+        print("file not exists:" + path)
+        return result
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#'):
+                continue
+            parts = line.split(sep)
+            if parts and len(parts) > 1:
+                for i, c in enumerate(parts):
+                    exist = result.get(c, set())
+                    current = set(list(parts[:i] + parts[i + 1:]))
+                    result[c] = exist.union(current)
+    return result
+
+
+def _load_custom_confusion(path):
+    """与Detector._get_custom_confusion_dict相同的解析规则, {variant: (origin, freq)}"""
+    confusion = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#'):
+                continue
+            info = line.split()
+            if len(info) < 2:
+                continue
+            freq = int(info[2]) if len(info) > 2 else 1
+            confusion[info[0]] = (info[1], freq)
+    return confusion
+
+
+def compile_snapshot(path=config.lexicon_snapshot_path, sources=None):
+    """
+    编译词典资源为二进制快照
+    :param path: 快照输出路径
+    :param sources: dict, {资源名: 源文件}, 默认取config中的路径
+    :return: dict, {资源名: 条目数}
+    """
+    from lm_detector import Detector
+    from bert_corrector import BertCorrector
+
+    loaders = {
+        'word_freq': Detector.load_word_freq_dict,
+        'common_char': lambda p: {w: True for w in load_set_file(p)},
+        'same_pinyin': load_same_pinyin,
+        'same_stroke': load_same_stroke,
+        'custom_confusion': _load_custom_confusion,
+        'bert_word_freq': BertCorrector.load_word_freq_dict,
+        'bert_same_stroke': BertCorrector.load_same_stroke,
+    }
+    writer = _SnapshotWriter()
+    sections = {}
+    # 内容相同的资源共用同一份数组
+    compiled = []
+    for name, (kind, default_path) in SNAPSHOT_SOURCES.items():
+        source_path = (sources or {}).get(SNAPSHOT_SOURCE_ALIASES.get(name, name), default_path)
+        if not source_path or not os.path.exists(source_path):
+            print('file not found.%s' % source_path)
+            continue
+        # 解析前取签名，解析期间文件被修改时快照会被判为过期
+        signature = _source_signature(source_path)
+        with parse_text():
+            items = list(loaders[name](source_path).items())
+        section = next((dict(s) for k, i, s in compiled if k == kind and i == items), None)
+        if section is None:
+            section = writer.add_table(kind, items)
+            compiled.append((kind, items, section))
+        section['source'] = os.path.abspath(source_path)
+        section['signature'] = signature
+        sections[name] = section
+    writer.write(path, sections)
+    return {name: section['count'] for name, section in sections.items()}
+
+
+if __name__ == "__main__":
+    import time
+
+    start = time.time()
+    counts = compile_snapshot(sys.argv[1] if len(sys.argv) > 1 else config.lexicon_snapshot_path)
+    print('Compiled lexicon snapshot: %s, time: %.2fs' % (counts, time.time() - start))
@@ -1,11 +1,11 @@
 import operator
-import os
 import time
-from codecs import open
-import pypinyin
 
 import config
+import profiling
+from lexicon_snapshot import load_same_pinyin, load_same_stroke, load_set_file
 from lm_detector import Detector, ErrorType
+from pinyin_index import load_same_pinyin_word_index
 from utils import edit_distance_word
 from utils import is_chinese_string, to_unicode
 from utils import segment, split_by_sym
@@ -22,6 +22,7 @@ class LMCorrector(Detector):
             custom_word_freq_path='',
             custom_confusion_path=config.custom_confusion_path,
             proper_name_path=config.proper_name_path,
+            same_pinyin_word_index_path=config.same_pinyin_word_index_path,
     ):
         super(LMCorrector, self).__init__(
             language_model_path=language_model_path,
@@ -34,74 +35,17 @@ class LMCorrector(Detector):
         self.common_char_path = common_char_path
         self.same_pinyin_text_path = same_pinyin_path
         self.same_stroke_text_path = same_stroke_path
+        self.same_pinyin_word_index_path = same_pinyin_word_index_path
         self.initialized_corrector = False
         self.cn_char_set = None
         self.same_pinyin = None
         self.same_stroke = None
+        self.word_index = None
 
-    @staticmethod
-    def load_set_file(path):
-        words = set()
-        with open(path, 'r', encoding='utf-8') as f:
-            for w in f:
-                w = w.strip()
-                if w.startswith('#'):
-                    continue
-                if w:
-                    words.add(w)
-        return words
-
-    @staticmethod
-    def load_same_pinyin(path, sep='\t'):
-        """
-        加载同音字
-        :param path:
-        :param sep:
-        :return:
-        """
-        result = dict()
-        if not os.path.exists(path):
-            print("file not exists:" + path)
-            return result
-        with open(path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('#'):
-                    continue
-                parts = line.split(sep)
-                if parts and len(parts) > 2:
-                    key_char = parts[0]
-                    same_pron_same_tone = set(list(parts[1]))
-                    same_pron_diff_tone = set(list(parts[2]))
-                    value = same_pron_same_tone.union(same_pron_diff_tone)
-                    if key_char and value:
-                        result[key_char] = value
-        return result
-
-    @staticmethod
-    def load_same_stroke(path, sep='\t'):
-        """
-        加载形似字
-        :param path:
-        :param sep:
-        :return:
-        """
-        result = dict()
-        if not os.path.exists(path):
-            print("file not exists:" + path)
-            return result
-        with open(path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line.startswith('#'):
-                    continue
-                parts = line.split(sep)
-                if parts and len(parts) > 1:
-                    for i, c in enumerate(parts):
-                        exist = result.get(c, set())
-                        current = set(list(parts[:i] + parts[i + 1:]))
-                        result[c] = exist.union(current)
-        return result
+    # 文本加载函数在lexicon_snapshot中，纠错数据生成等只读词典的场景不必导入kenlm
+    load_set_file = staticmethod(load_set_file)
+    load_same_pinyin = staticmethod(load_same_pinyin)
+    load_same_stroke = staticmethod(load_same_stroke)
 
     def _initialize_corrector(self):
         # chinese common char
@@ -110,6 +54,16 @@ class LMCorrector(Detector):
         self.same_pinyin = self.load_same_pinyin(self.same_pinyin_text_path)
         # same stroke
         self.same_stroke = self.load_same_stroke(self.same_stroke_text_path)
+        # same pinyin word index
+        self.check_detector_initialized()
+        self.word_index = load_same_pinyin_word_index(
+            self.word_freq.keys(),
+            self.cn_char_set,
+            [self.word_freq_path, self.custom_word_freq_path, self.custom_confusion_path, self.common_char_path],
+            path=self.same_pinyin_word_index_path,
+        )
+        # 索引缓存不含set_word_frequency新增的词
+        self.word_index.update(self._updated_word_freq)
         self.initialized_corrector = True
 
     def check_corrector_initialized(self):
@@ -134,6 +88,35 @@ class LMCorrector(Detector):
         self.check_corrector_initialized()
         return self.same_stroke.get(char, set())
 
+    def set_custom_confusion_dict(self, path):
+        super(LMCorrector, self).set_custom_confusion_dict(path)
+        # 混淆集纠正词已加入词频词典，同步到同音近邻词索引
+        if self.word_index is not None:
+            self.word_index.update(self.custom_confusion.values())
+
+    def set_word_frequency(self, word, num):
+        result = super(LMCorrector, self).set_word_frequency(word, num)
+        if self.word_index is not None:
+            self.word_index.add(word)
+        return result
+
+    def for_tenant(self, tenant_id, custom_confusion_path='', custom_word_freq_path=''):
+        self.check_corrector_initialized()
+        view = super(LMCorrector, self).for_tenant(tenant_id, custom_confusion_path, custom_word_freq_path)
+        # 租户新增的词在共享索引上叠加
+        view.word_index = self.word_index.derive()
+        view.word_index.update(view.word_freq.maps[0])
+        return view
+
+    def dictionary_paths(self):
+        return super(LMCorrector, self).dictionary_paths() + [
+            self.common_char_path, self.same_pinyin_text_path, self.same_stroke_text_path]
+
+    def _load_dictionaries(self):
+        super(LMCorrector, self)._load_dictionaries()
+        if self.initialized_corrector:
+            self._initialize_corrector()
+
     def known(self, words):
         """
         取得词序列中属于常用词部分
@@ -147,10 +130,14 @@ class LMCorrector(Detector):
         return self.get_same_pinyin(c).union(self.get_same_stroke(c))
 
     def _confusion_word_set(self, word):
-        confusion_word_set = set()
-        candidate_words = list(self.known(edit_distance_word(word, self.cn_char_set)))
+        self.check_corrector_initialized()
+        pinyin = self.word_index.get_pinyin(word)
+        # 替换一个常用字的同音词，查索引
+        confusion_word_set = self.word_index.get_replace_words(word, pinyin)
+        # 相邻字交换的候选很少，直接生成
+        candidate_words = list(self.known(edit_distance_word(word, self.word_index.multi_chars)))
         for candidate_word in candidate_words:
-            if pypinyin.lazy_pinyin(candidate_word) == pypinyin.lazy_pinyin(word):
+            if self.word_index.get_pinyin(candidate_word) == pinyin:
                 # same pinyin
                 confusion_word_set.add(candidate_word)
         return confusion_word_set
@@ -161,6 +148,7 @@ class LMCorrector(Detector):
             confusion_word_set = {self.custom_confusion[word]}
         return confusion_word_set
 
+    @profiling.timed('lm.generate_items')
     def generate_items(self, word, fragment=1):
         """
         生成纠错候选集
@@ -213,8 +201,11 @@ class LMCorrector(Detector):
         confusion_word_set = set(candidates_1 + candidates_2 + candidates_3)
         confusion_word_list = [item for item in confusion_word_set if is_chinese_string(item)]
         confusion_sorted = sorted(confusion_word_list, key=lambda k: self.word_frequency(k), reverse=True)
-        return confusion_sorted[:len(confusion_word_list) // fragment + 1]
+        candidates = confusion_sorted[:len(confusion_word_list) // fragment + 1]
+        profiling.observe('lm.candidates', len(candidates))
+        return candidates
 
+    @profiling.timed('lm.rescore')
     def get_lm_correct_item(self, cur_item, candidates, before_sent, after_sent, threshold=57, cut_type='char'):
         """
         通过语言模型纠正字词错误
@@ -230,7 +221,12 @@ class LMCorrector(Detector):
         if cur_item not in candidates:
             candidates.append(cur_item)
 
-        ppl_scores = {i: self.ppl_score(segment(before_sent + i + after_sent, cut_type=cut_type)) for i in candidates}
+        if cut_type == 'char':
+            # 只重算替换位置附近的n元文法窗口
+            ppl_scores = self.ppl_scores_by_window(before_sent, candidates, after_sent, cur_item=cur_item)
+        else:
+            ppl_scores = {i: self.ppl_score(segment(before_sent + i + after_sent, cut_type=cut_type))
+                          for i in candidates}
         sorted_ppl_scores = sorted(ppl_scores.items(), key=lambda d: d[1])
 
         # 增加正确字词的修正范围，减少误纠
@@ -251,6 +247,7 @@ class LMCorrector(Detector):
             result = top_items[0]
         return result
 
+    @profiling.timed('lm.correct')
     def correct(self, text, include_symbol=True, num_fragment=1, threshold=57, **kwargs):
         """
         文本改错
@@ -265,43 +262,67 @@ class LMCorrector(Detector):
         :param kwargs: ...
         :return: text (str)改正后的句子, list(wrong, right, begin_idx, end_idx)
         """
-        text_new = ''
-        details = []
-        self.check_corrector_initialized()
-        # 编码统一，utf-8 to unicode
-        text = to_unicode(text)
-        # 文本切分为句子
-        sentences = split_by_sym(text, include_symbol=include_symbol)
-        for sentence, idx in sentences:
-            maybe_errors = self.detect_sentence(sentence, idx, **kwargs)
-            for cur_item, begin_idx, end_idx, err_type in maybe_errors:
-                # 纠错，逐个处理
-                before_sent = sentence[:(begin_idx - idx)]
-                after_sent = sentence[(end_idx - idx):]
+        return self.correct_batch([text], include_symbol=include_symbol, num_fragment=num_fragment,
+                                  threshold=threshold, **kwargs)[0]
+
+    def _correct_sentence(self, sentence, idx, maybe_errors, details, num_fragment=1, threshold=57):
+        """
+        纠正句子中检测到的疑似错误
+        :return: str, 改正后的句子, 错误追加到details
+        """
+        for cur_item, begin_idx, end_idx, err_type in maybe_errors:
+            # 纠错，逐个处理
+            before_sent = sentence[:(begin_idx - idx)]
+            after_sent = sentence[(end_idx - idx):]
 
-                # 困惑集中指定的词，直接取结果
-                if err_type == ErrorType.confusion:
-                    corrected_item = self.custom_confusion[cur_item]
-                else:
-                    # 字词错误，找所有可能正确的词
-                    candidates = self.generate_items(cur_item, fragment=num_fragment)
-                    if not candidates:
-                        continue
-                    corrected_item = self.get_lm_correct_item(
-                        cur_item,
-                        candidates,
-                        before_sent,
-                        after_sent,
-                        threshold=threshold
-                    )
-                # output
-                if corrected_item != cur_item:
-                    sentence = before_sent + corrected_item + after_sent
-                    detail_word = (cur_item, corrected_item, begin_idx, end_idx)
-                    details.append(detail_word)
-            text_new += sentence
-        details = sorted(details, key=operator.itemgetter(2))
-        return text_new, details
+            # 困惑集中指定的词，直接取结果
+            if err_type == ErrorType.confusion:
+                corrected_item = self.custom_confusion[cur_item]
+            else:
+                # 字词错误，找所有可能正确的词
+                candidates = self.generate_items(cur_item, fragment=num_fragment)
+                if not candidates:
+                    continue
+                corrected_item = self.get_lm_correct_item(
+                    cur_item,
+                    candidates,
+                    before_sent,
+                    after_sent,
+                    threshold=threshold
+                )
+            # output
+            if corrected_item != cur_item:
+                sentence = before_sent + corrected_item + after_sent
+                detail_word = (cur_item, corrected_item, begin_idx, end_idx)
+                details.append(detail_word)
+        return sentence
+
+    @profiling.timed('lm.correct_batch')
+    def correct_batch(self, texts, include_symbol=True, num_fragment=1, threshold=57, **kwargs):
+        """
+        批量文本改错，全部文本的句子一次批量检测，结果与逐个调用correct一致
+        :param texts: list, 文本
+        :param include_symbol: bool, 是否包含标点符号
+        :param num_fragment: 纠错候选集分段数, 1 / (num_fragment + 1)
+        :param threshold: 语言模型纠错ppl阈值
+        :return: list, [(text_new, details)]
+        """
+        self.check_corrector_initialized()
+        # 编码统一，utf-8 to unicode; 文本切分为句子
+        text_sentences = [split_by_sym(to_unicode(text), include_symbol=include_symbol) for text in texts]
+        all_sentences = [item for sentences in text_sentences for item in sentences]
+        detections = iter(self.detect_batch([sentence for sentence, _ in all_sentences],
+                                            [idx for _, idx in all_sentences]))
+        results = []
+        for sentences in text_sentences:
+            text_new = ''
+            details = []
+            for sentence, idx in sentences:
+                text_new += self._correct_sentence(sentence, idx, next(detections), details,
+                                                   num_fragment=num_fragment, threshold=threshold)
+            details = sorted(details, key=operator.itemgetter(2))
+            results.append((text_new, details))
+        return results
 
 
 if __name__ == "__main__":
@@ -1,13 +1,21 @@
+import bisect
+import copy
 import os
+import threading
 import time
 from codecs import open
+from collections import ChainMap
+from functools import lru_cache
 import kenlm
 
 import numpy as np
 
 import config
+import profiling
+from lexicon_snapshot import OverlayMap, get_snapshot_table
 from utils import is_english_string, to_unicode, is_chinese_string
-from utils import Tokenizer, split_by_sym
+from utils import Tokenizer, WordTrie, OverlayWordTrie, split_by_sym
+from utils import resource_version
 
 
 class ErrorType(object):
@@ -16,6 +24,65 @@ class ErrorType(object):
     char = 'char'
 
 
+class SuspectIndex(object):
+    """
+    句子的疑似错误集合，按(开始位置, 加入顺序)有序
+    树状数组记录开始位置不大于某位置的错误的最大结束位置，O(log n)判断新错误是否已被包含
+    """
+
+    def __init__(self, start_idx=0, length=0):
+        """
+        :param start_idx: 句子在原文中的起始位置
+        :param length: 句子长度
+        """
+        self.start_idx = start_idx
+        self._tree = [-1] * (length + 2)
+        self._keys = []
+        self._items = []
+
+    def _position(self, begin):
+        return min(max(begin - self.start_idx + 1, 0), len(self._tree) - 1)
+
+    def contains(self, begin, end):
+        """是否已有错误包含[begin, end)"""
+        i = self._position(begin)
+        max_end = -1
+        while i > 0:
+            if self._tree[i] > max_end:
+                max_end = self._tree[i]
+            i -= i & -i
+        return max_end >= end
+
+    def add(self, maybe_err):
+        """
+        加入错误，已被包含时忽略
+        :param maybe_err: [error_word, begin_pos, end_pos, error_type]
+        :return: bool, 是否加入
+        """
+        begin, end = maybe_err[1], maybe_err[2]
+        if self.contains(begin, end):
+            return False
+        i = self._position(begin)
+        while 0 < i < len(self._tree):
+            if self._tree[i] < end:
+                self._tree[i] = end
+            i += i & -i
+        key = (begin, len(self._keys))
+        pos = bisect.bisect(self._keys, key)
+        self._keys.insert(pos, key)
+        self._items.insert(pos, maybe_err)
+        return True
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def to_list(self):
+        return list(self._items)
+
+
 class Detector(object):
     def __init__(
             self,
@@ -34,8 +101,14 @@ class Detector(object):
         self.is_word_error_detect = True
         self.initialized_detector = False
         self.lm = None
+        # 单字、双字起始的语言模型状态缓存, {chars: (score, state)}
+        self._prefix_states = {}
+        # 上一次整句打分时逐字的状态和累计得分，按线程隔离
+        self._sentence_prefix = threading.local()
         self.word_freq = None
         self.custom_confusion = None
+        # 混淆集编译后的前缀树
+        self.confusion_trie = None
         self.custom_word_freq = None
         self.person_names = None
         self.place_names = None
@@ -44,21 +117,33 @@ class Detector(object):
         self.proper_corrector = None
         self.proper_name_path = proper_name_path
         # self.stroke_path = stroke_path
+        # 资源版本号，词典或语言模型变化后失效，用于结果缓存
+        self._resource_version = None
+        self._updated_word_freq = {}
+        # 租户视图的租户ID及其词典文件
+        self.tenant_id = None
+        self._tenant_paths = []
 
     def _initialize_detector(self):
         self.lm = kenlm.Model(self.language_model_path)
+        self._prefix_states = {}
+        self._load_dictionaries()
+        self.initialized_detector = True
 
+    def _load_dictionaries(self):
         # 词、频数dict
         self.word_freq = self.load_word_freq_dict(self.word_freq_path)
         # 自定义混淆集
         self.custom_confusion = self._get_custom_confusion_dict(self.custom_confusion_path)
+        self.confusion_trie = WordTrie(self.custom_confusion.keys())
         # 自定义切词词典
         self.custom_word_freq = self.load_word_freq_dict(self.custom_word_freq_path)
         self.word_freq.update(self.custom_word_freq)
+        # set_word_frequency修改过的词频在重新加载后保留
+        self.word_freq.update(self._updated_word_freq)
         self.tokenizer = Tokenizer(dict_path=self.word_freq_path,
                                    custom_word_freq_dict=self.custom_word_freq,
                                    custom_confusion_dict=self.custom_confusion)
-        self.initialized_detector = True
 
     def check_detector_initialized(self):
         if not self.initialized_detector:
@@ -67,10 +152,14 @@ class Detector(object):
     @staticmethod
     def load_word_freq_dict(path):
         """
-        加载切词词典
+        加载切词词典，有与词典文件一致的二进制快照时直接在快照上查找，不解析文本
         :param path:
         :return:
         """
+        table = get_snapshot_table('word_freq', path)
+        if table is not None:
+            # 查找在mmap上进行，不在各进程复制整张表；新增或修改的词频写入叠加层
+            return OverlayMap({}, table)
         word_freq = {}
         if path:
             if not os.path.exists(path):
@@ -98,6 +187,12 @@ class Detector(object):
         :return: dict, {variant: origin}, eg: {"交通先行": "交通限行"}
         """
         confusion = {}
+        table = get_snapshot_table('custom_confusion', path)
+        if table is not None:
+            for variant, (origin, freq) in table.items():
+                self.word_freq[origin] = freq
+                confusion[variant] = origin
+            return confusion
         if path:
             if not os.path.exists(path):
                 print('file not found.%s' % path)
@@ -121,11 +216,17 @@ class Detector(object):
     def set_language_model_path(self, path):
         self.check_detector_initialized()
         self.lm = kenlm.Model(path)
+        self.language_model_path = path
+        self._prefix_states = {}
+        self._resource_version = None
         print('Loaded language model: %s' % path)
 
     def set_custom_confusion_dict(self, path):
         self.check_detector_initialized()
+        self.custom_confusion_path = path
         self.custom_confusion = self._get_custom_confusion_dict(path)
+        self.confusion_trie = WordTrie(self.custom_confusion.keys())
+        self._resource_version = None
 
     def set_custom_word_freq(self, path):
         self.check_detector_initialized()
@@ -140,6 +241,61 @@ class Detector(object):
             self.set_word_frequency(k, v)
         print('Loaded custom word path: %s, size: %d' % (path, len(word_freqs)))
 
+    def reloaded(self):
+        """
+        重新加载词典，返回新的检测器，语言模型共享
+        本检测器不变，正在处理的请求继续使用旧词典，由调用方原子替换
+        :return: 与本检测器同类型的对象
+        """
+        self.check_detector_initialized()
+        if self.tenant_id is not None:
+            raise ValueError('reload the base detector and derive tenant views again')
+        start = time.time()
+        detector = copy.copy(self)
+        detector._sentence_prefix = threading.local()
+        detector._updated_word_freq = dict(self._updated_word_freq)
+        detector._resource_version = None
+        detector._load_dictionaries()
+        print('Reloaded dictionaries, time: %.2fs' % (time.time() - start))
+        return detector
+
+    @staticmethod
+    def _overlay(mapping, layer=None):
+        """
+        在mapping上叠加一层dict，查找先查叠加层，写入只落在叠加层，不复制mapping
+        """
+        maps = mapping.maps if isinstance(mapping, ChainMap) else [mapping]
+        return OverlayMap({} if layer is None else layer, *maps)
+
+    def for_tenant(self, tenant_id, custom_confusion_path='', custom_word_freq_path=''):
+        """
+        派生租户视图：共享本检测器的语言模型和基础词典，租户的混淆集、自定义词只存于叠加层，
+        内存随租户词典大小增长，修改视图的词频、混淆集不影响本检测器及其他租户
+        :param tenant_id: 租户ID
+        :param custom_confusion_path: 租户混淆集
+        :param custom_word_freq_path: 租户自定义词典
+        :return: 与本检测器同类型的对象
+        """
+        self.check_detector_initialized()
+        view = copy.copy(self)
+        view.tenant_id = tenant_id
+        view._tenant_paths = [custom_confusion_path, custom_word_freq_path]
+        view._sentence_prefix = threading.local()
+        view._updated_word_freq = dict(self._updated_word_freq)
+        view._resource_version = None
+        view.word_freq = self._overlay(self.word_freq)
+        # 纠正词的词频写入视图的叠加层
+        tenant_confusion = view._get_custom_confusion_dict(custom_confusion_path)
+        tenant_word_freq = self.load_word_freq_dict(custom_word_freq_path)
+        view.word_freq.update(tenant_word_freq)
+        view.custom_confusion = self._overlay(self.custom_confusion, tenant_confusion)
+        view.confusion_trie = OverlayWordTrie(tenant_confusion.keys(), self.confusion_trie)
+        view.custom_word_freq = self._overlay(self.custom_word_freq, tenant_word_freq)
+        view.tokenizer = self.tokenizer.derive(tenant_word_freq, tenant_confusion)
+        print('Loaded tenant: %s, confusion size: %d, word size: %d' % (
+            tenant_id, len(tenant_confusion), len(tenant_word_freq)))
+        return view
+
     def enable_char_error(self, enable=True):
         """
         is open char error detect
@@ -165,6 +321,195 @@ class Detector(object):
         self.check_detector_initialized()
         return self.lm.score(' '.join(chars), bos=False, eos=False)
 
+    def char_ngram_scores(self, sentence, orders=(2, 3)):
+        """
+        一次遍历取句子全部字级n元文法得分，沿kenlm状态逐字累加，
+        结果与逐个调用ngram_score(list(sentence[i:i + n]))一致
+        :param sentence: str
+        :param orders: n元列表
+        :return: dict, {n: np.array}, 长度为len(sentence) - n + 1
+        """
+        self.check_detector_initialized()
+        chars = list(sentence)
+        if ''.join(sentence.split()) != sentence:
+            # kenlm按空白切分，空白字不计分，退回逐个打分
+            return {n: np.array([self.ngram_score(chars[i:i + n]) for i in range(len(chars) - n + 1)])
+                    for n in orders}
+        base_score = self.lm.BaseScore
+        length = len(chars)
+        max_n = min(max(orders), length)
+        # 单字、双字起始的状态只与这几个字有关，缓存复用
+        prefix_states = self._prefix_states
+        if len(prefix_states) > 200000:
+            prefix_states.clear()
+        # 第k层为以sentence[i]起始时，第k个字在前文条件下的得分
+        cond_scores = []
+        states = []
+        for k in range(max_n):
+            size = length - k
+            if k < 2:
+                items = [prefix_states.get(sentence[i:i + k + 1]) for i in range(size)]
+                for i, item in enumerate(items):
+                    if item is None:
+                        if k == 0:
+                            in_state = kenlm.State()
+                            self.lm.NullContextWrite(in_state)
+                        else:
+                            in_state = states[i]
+                        out_state = kenlm.State()
+                        item = (base_score(in_state, chars[i + k], out_state), out_state)
+                        prefix_states[sentence[i:i + k + 1]] = items[i] = item
+                cond_scores.extend([item[0] for item in items])
+                states = [item[1] for item in items]
+            elif k == max_n - 1:
+                # 最后一层无需保留状态
+                out_state = kenlm.State()
+                cond_scores.extend([base_score(states[i], chars[i + k], out_state) for i in range(size)])
+            else:
+                next_states = [kenlm.State() for _ in range(size)]
+                cond_scores.extend([base_score(states[i], chars[i + k], next_states[i]) for i in range(size)])
+                states = next_states
+        # kenlm.score以float32累加
+        cond_scores = np.array(cond_scores, dtype=np.float32)
+        result = {}
+        partial = cond_scores[:length]
+        offset = length
+        for k in range(max_n):
+            if k:
+                size = length - k
+                partial = partial[:size] + cond_scores[offset:offset + size]
+                offset += size
+            if k + 1 in orders:
+                result[k + 1] = partial.astype(np.float64)
+        for n in orders:
+            if n not in result:
+                result[n] = np.array([], dtype=np.float64)
+        return result
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _get_window_index(length, n):
+        """
+        移动窗口补全后，各位置窗口内第j个得分对应的原始下标
+        :param length: 句子长度
+        :param n: n元
+        :return: tuple(np.array), 共n个
+        """
+        positions = np.arange(length)
+        return tuple(np.clip(positions + j - (n - 1), 0, length - n) for j in range(n))
+
+    def _get_ngram_avg_scores(self, sentence, orders=(2, 3)):
+        """
+        取句子逐字的n元文法平均得分，两端按移动窗口补全
+        :param sentence: str
+        :param orders: n元列表
+        :return: np.array, 无得分时返回None
+        """
+        ngram_avg_scores = []
+        ngram_scores = self.char_ngram_scores(sentence, orders)
+        for n in orders:
+            scores = ngram_scores[n]
+            if not len(scores):
+                continue
+            # 移动窗口补全得分
+            window = self._get_window_index(len(sentence), n)
+            window_sum = scores[window[0]]
+            for index in window[1:]:
+                window_sum = window_sum + scores[index]
+            ngram_avg_scores.append(window_sum / n)
+        if not ngram_avg_scores:
+            return None
+        # 取拼接后的n-gram平均得分
+        sent_scores = ngram_avg_scores[0]
+        for avg_scores in ngram_avg_scores[1:]:
+            sent_scores = sent_scores + avg_scores
+        return sent_scores / len(ngram_avg_scores)
+
+    def _walk_sentence(self, words):
+        """
+        从句首逐字计算语言模型得分，复用上一次调用中相同前缀的结果
+        :param words: list, 字
+        :return: 缓存对象, states[i]/totals[i]为前i字后的状态及float32累计得分, scores[i]为第i字得分
+        """
+        cache = self._sentence_prefix
+        if getattr(cache, 'lm', None) is not self.lm:
+            begin_state = kenlm.State()
+            self.lm.BeginSentenceWrite(begin_state)
+            cache.lm = self.lm
+            cache.words = []
+            cache.scores = []
+            cache.states = [begin_state]
+            cache.totals = [np.float32(0)]
+        cached_words = cache.words
+        same = 0
+        max_same = min(len(words), len(cached_words))
+        while same < max_same and words[same] == cached_words[same]:
+            same += 1
+        del cached_words[same:], cache.scores[same:], cache.states[same + 1:], cache.totals[same + 1:]
+        state = cache.states[-1]
+        total = cache.totals[-1]
+        for word in words[same:]:
+            out_state = kenlm.State()
+            score = self.lm.BaseScore(state, word, out_state)
+            # kenlm.score以float32累加
+            total = total + np.float32(score)
+            state = out_state
+            cached_words.append(word)
+            cache.scores.append(score)
+            cache.states.append(state)
+            cache.totals.append(total)
+        return cache
+
+    def ppl_scores_by_window(self, before_sent, items, after_sent, cur_item=None):
+        """
+        计算before_sent + item + after_sent的字级困惑度，只重算替换影响到的n元文法窗口：
+        整句逐字状态跨调用复用，后半句在n-1字之后的得分与替换内容无关，直接取缓存。
+        结果与ppl_score(segment(before_sent + item + after_sent, cut_type='char'))一致
+        :param before_sent: 前半部分句子
+        :param items: list, 替换内容
+        :param after_sent: 后半部分句子
+        :param cur_item: 句中当前内容, 默认取items[0]
+        :return: dict, {item: ppl}
+        """
+        self.check_detector_initialized()
+        base_score = self.lm.BaseScore
+        if cur_item is None:
+            cur_item = items[0] if items else ''
+        # kenlm按空白切分，空白字不计分
+        before = [c for c in before_sent if not c.isspace()]
+        after = [c for c in after_sent if not c.isspace()]
+        cur_words = [c for c in cur_item if not c.isspace()]
+        sentence = self._walk_sentence(before + cur_words + after)
+        prefix_state = sentence.states[len(before)]
+        prefix_total = sentence.totals[len(before)]
+
+        context = self.lm.order - 1
+        window = after[:context]
+        if len(after) >= context:
+            # 后半句前n-1字之后的条件概率只依赖后半句本身，与替换内容无关
+            tail_scores = sentence.scores[len(before) + len(cur_words) + context:]
+            tail_scores.append(base_score(sentence.states[-1], '</s>', kenlm.State()))
+        else:
+            tail_scores = []
+        tail_scores = np.array(tail_scores, dtype=np.float32)
+
+        result = {}
+        for item in items:
+            item_words = [c for c in item if not c.isspace()]
+            scores = [prefix_total]
+            state = prefix_state
+            for word in item_words + window:
+                out_state = kenlm.State()
+                scores.append(base_score(state, word, out_state))
+                state = out_state
+            if len(after) < context:
+                scores.append(base_score(state, '</s>', kenlm.State()))
+            # 按原顺序以float32逐个累加
+            total = np.add.accumulate(np.concatenate((np.array(scores, dtype=np.float32), tail_scores)))[-1]
+            words_len = len(before) + len(item_words) + len(after) + 1
+            result[item] = 10.0 ** (-float(total) / words_len)
+        return result
+
     def ppl_score(self, words):
         """
         取语言模型困惑度得分，越小句子越通顺
@@ -189,8 +534,34 @@ class Detector(object):
         """
         self.check_detector_initialized()
         self.word_freq[word] = num
+        self._updated_word_freq[word] = num
+        self._resource_version = None
         return self.word_freq
 
+    def dictionary_paths(self):
+        """
+        词典文件，文件变化后可用reloaded重新加载
+        :return: list
+        """
+        return [self.word_freq_path, self.custom_word_freq_path, self.custom_confusion_path, self.proper_name_path]
+
+    def _resource_paths(self):
+        return [self.language_model_path] + self.dictionary_paths() + self._tenant_paths
+
+    def get_resource_version(self):
+        """
+        取词典及语言模型的版本号，set_custom_confusion_dict、set_custom_word_freq等修改资源后版本号改变
+        :return: str
+        """
+        if self._resource_version is None:
+            self.check_detector_initialized()
+            self._resource_version = resource_version(
+                self._resource_paths(),
+                sorted(self.custom_confusion.items()),
+                sorted(self._updated_word_freq.items()),
+            )
+        return self._resource_version
+
     @staticmethod
     def _check_contain_error(maybe_err, maybe_errors):
         """
@@ -211,11 +582,14 @@ class Detector(object):
     def _add_maybe_error_item(self, maybe_err, maybe_errors):
         """
         新增错误
+        错误词均取自句子本身，位置被已有错误包含时错误词也是其子串，与_check_contain_error的判断一致
         :param maybe_err:
-        :param maybe_errors:
+        :param maybe_errors: SuspectIndex, 或list
         :return:
         """
-        if maybe_err not in maybe_errors and not self._check_contain_error(maybe_err, maybe_errors):
+        if isinstance(maybe_errors, SuspectIndex):
+            maybe_errors.add(maybe_err)
+        elif maybe_err not in maybe_errors and not self._check_contain_error(maybe_err, maybe_errors):
             maybe_errors.append(maybe_err)
 
     @staticmethod
@@ -245,6 +619,50 @@ class Detector(object):
         result = [int(i) for i in maybe_error_indices[0]]
         return result
 
+    @staticmethod
+    def _segment_median(values, starts, lengths):
+        """
+        分段中位数，values已在各段内升序排列，与np.median的取值一致
+        :return: np.array, 各段的中位数
+        """
+        low = values[starts + (lengths - 1) // 2]
+        high = values[starts + lengths // 2]
+        return (low + high) / 2
+
+    @staticmethod
+    def _get_maybe_error_indices(scores_list, ratio=0.6745, threshold=2):
+        """
+        批量取疑似错字的位置，结果与逐句调用_get_maybe_error_index一致
+        各句得分拼为一个数组，按句排序后分段取中位数和MAD
+        :param scores_list: list, 各句的逐字得分, np.array
+        :param ratio: 正态分布表参数
+        :param threshold: 阈值越小，得到疑似错别字越多
+        :return: list, 各句全部疑似错误字的index
+        """
+        if not scores_list:
+            return []
+        lengths = np.array([len(scores) for scores in scores_list])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        flat = np.concatenate([np.asarray(scores, dtype=np.float64).ravel() for scores in scores_list])
+        segment_ids = np.repeat(np.arange(len(scores_list)), lengths)
+
+        # 段内排序: 先按句、再按得分
+        order = np.lexsort((flat, segment_ids))
+        median = Detector._segment_median(flat[order], starts, lengths)
+        margin_median = np.abs(flat - median[segment_ids])  # deviation from the median
+        order = np.lexsort((margin_median, segment_ids))
+        # 平均绝对离差值
+        med_abs_deviation = Detector._segment_median(margin_median[order], starts, lengths)
+        mad = med_abs_deviation[segment_ids]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            y_score = ratio * margin_median / mad
+        maybe_error = (mad != 0) & (y_score > threshold) & (flat < median[segment_ids])
+        positions = np.arange(len(flat)) - starts[segment_ids]
+        result = [[] for _ in scores_list]
+        for segment_id, position in zip(segment_ids[maybe_error].tolist(), positions[maybe_error].tolist()):
+            result[segment_id].append(position)
+        return result
+
     @staticmethod
     def _get_maybe_error_index_by_stddev(scores, n=2):
         """
@@ -299,8 +717,8 @@ class Detector(object):
         text = to_unicode(text)
         # 文本切分为句子
         sentences = split_by_sym(text)
-        for sentence, idx in sentences:
-            maybe_errors += self.detect_sentence(sentence, idx)[0]
+        for sentence_errors in self.detect_batch([s for s, _ in sentences], [idx for _, idx in sentences]):
+            maybe_errors += sentence_errors
         return maybe_errors
 
 
@@ -328,20 +746,12 @@ class Detector(object):
 
 
 
-    def detect_sentence(self, sentence, start_idx=0, **kwargs):
+    def _detect_words(self, sentence, start_idx=0):
         """
-        检测句子中的疑似错误字词，包括[词、位置、错误类型]
-        检测逻辑：
-        1. 自定义混淆集
-        3. 词错误
-        4. 字错误
-        :param sentence:
-        :param start_idx:
-        :return: list[list], [error_word, begin_pos, end_pos, error_type]
+        检测混淆集中的词及未登录词
+        :return: SuspectIndex
         """
-        maybe_errors = []
-        # 初始化
-        self.check_detector_initialized()
+        maybe_errors = SuspectIndex(start_idx, len(sentence))
         # 1. 自定义混淆集加入疑似错误词典
             # 直接索引法
         # for confuse in self.custom_confusion:
@@ -350,9 +760,9 @@ class Detector(object):
         #         maybe_err = [confuse, idx + start_idx, idx + len(confuse) + start_idx, ErrorType.confusion]
         #         self._add_maybe_error_item(maybe_err, maybe_errors)
 
-            # 前向最大匹配-遍历小的匹配大的：
-        max_len = self._get_max_len(self.custom_confusion.keys())
-        idxs, confuses = self.FMM(self.custom_confusion, sentence, max_len)
+            # 前向最大匹配，混淆集已编译为前缀树
+        with profiling.stage('detect.confusion'):
+            idxs, confuses = self.confusion_trie.fmm(sentence)
         if len(idxs) > 0:
             for idx, confuse in zip(idxs, confuses):
                 maybe_err = [confuse, idx + start_idx, idx + len(confuse) + start_idx, ErrorType.confusion]
@@ -360,7 +770,8 @@ class Detector(object):
 
         # 2. 词错误
         if self.is_word_error_detect:
-            tokens = self.tokenizer.tokenize(sentence)
+            with profiling.stage('detect.tokenize'):
+                tokens = self.tokenizer.tokenize(sentence)
             # 未登录词加入疑似错误词典
             for token, begin_idx, end_idx in tokens:
                 # pass filter word
@@ -371,44 +782,80 @@ class Detector(object):
                     continue
                 maybe_err = [token, begin_idx + start_idx, end_idx + start_idx, ErrorType.word]
                 self._add_maybe_error_item(maybe_err, maybe_errors)
+        return maybe_errors
+
+    def _get_sentence_scores(self, sentence):
+        """取逐字n元文法平均得分，出错时返回None"""
+        try:
+            with profiling.stage('detect.ngram'):
+                return self._get_ngram_avg_scores(sentence)
+        except IndexError as ie:
+            print("index error, sentence:" + sentence + str(ie))
+        except Exception as e:
+            print("detect error, sentence:" + sentence + str(e))
+        return None
+
+    def _add_char_errors(self, sentence, start_idx, indices, maybe_errors):
+        # 取疑似错字信息
+        for i in indices:
+            token = sentence[i]
+            # pass filter word
+            if self.is_filter_token(token):
+                continue
+            # pass in stop word dict
+            if token in self.stopwords:
+                continue
+            # token, begin_idx, end_idx, error_type
+            maybe_err = [token, i + start_idx, i + start_idx + 1,
+                         ErrorType.char]
+            self._add_maybe_error_item(maybe_err, maybe_errors)
+
+    @profiling.timed('detect.sentence')
+    def detect_sentence(self, sentence, start_idx=0, **kwargs):
+        """
+        检测句子中的疑似错误字词，包括[词、位置、错误类型]
+        检测逻辑：
+        1. 自定义混淆集
+        3. 词错误
+        4. 字错误
+        :param sentence:
+        :param start_idx:
+        :return: list[list], [error_word, begin_pos, end_pos, error_type]
+        """
+        # 初始化
+        self.check_detector_initialized()
+        maybe_errors = self._detect_words(sentence, start_idx)
 
         # 4. 字错误，语言模型检测疑似错误字
         if self.is_char_error_detect:
-            try:
-                ngram_avg_scores = []
-                for n in [2, 3]:
-                    scores = []
-                    for i in range(len(sentence) - n + 1):
-                        word = sentence[i:i + n]
-                        score = self.ngram_score(list(word))
-                        scores.append(score)
-                    if not scores:
-                        continue
-                    # 移动窗口补全得分
-                    for _ in range(n - 1):
-                        scores.insert(0, scores[0])
-                        scores.append(scores[-1])
-                    avg_scores = [sum(scores[i:i + n]) / len(scores[i:i + n]) for i in range(len(sentence))]
-                    ngram_avg_scores.append(avg_scores)
-
-                if ngram_avg_scores:
-                    # 取拼接后的n-gram平均得分
-                    sent_scores = list(np.average(np.array(ngram_avg_scores), axis=0))
-                    # 取疑似错字信息
-                    for i in self._get_maybe_error_index(sent_scores):
-                        token = sentence[i]
-                        # pass filter word
-                        if self.is_filter_token(token):
-                            continue
-                        # pass in stop word dict
-                        if token in self.stopwords:
-                            continue
-                        # token, begin_idx, end_idx, error_type
-                        maybe_err = [token, i + start_idx, i + start_idx + 1,
-                                     ErrorType.char]
-                        self._add_maybe_error_item(maybe_err, maybe_errors)
-            except IndexError as ie:
-                print("index error, sentence:" + sentence + str(ie))
-            except Exception as e:
-                print("detect error, sentence:" + sentence + str(e))
-        return sorted(maybe_errors, key=lambda k: k[1], reverse=False)
\ No newline at end of file
+            sent_scores = self._get_sentence_scores(sentence)
+            if sent_scores is not None:
+                self._add_char_errors(sentence, start_idx, self._get_maybe_error_index(sent_scores), maybe_errors)
+        return maybe_errors.to_list()
+
+    @profiling.timed('detect.batch')
+    def detect_batch(self, sentences, start_idxs=None):
+        """
+        批量检测，结果与逐句调用detect_sentence一致
+        全部句子的逐字得分拼为一个数组，分段一次算出各句的中位数和MAD
+        :param sentences: list, 句子
+        :param start_idxs: list, 各句的起始位置, 默认为0
+        :return: list, 各句的[error_word, begin_pos, end_pos, error_type]
+        """
+        self.check_detector_initialized()
+        if start_idxs is None:
+            start_idxs = [0] * len(sentences)
+        results = [self._detect_words(sentence, start_idx) for sentence, start_idx in zip(sentences, start_idxs)]
+
+        # 4. 字错误，语言模型检测疑似错误字
+        if self.is_char_error_detect:
+            scored = []
+            scores = []
+            for i, sentence in enumerate(sentences):
+                sent_scores = self._get_sentence_scores(sentence)
+                if sent_scores is not None and len(sent_scores):
+                    scored.append(i)
+                    scores.append(sent_scores)
+            for i, indices in zip(scored, self._get_maybe_error_indices(scores)):
+                self._add_char_errors(sentences[i], start_idxs[i], indices, results[i])
+        return [maybe_errors.to_list() for maybe_errors in results]
\ No newline at end of file
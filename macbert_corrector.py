@@ -2,15 +2,39 @@
 import operator
 import time
 import os
-from transformers import BertTokenizer, BertForMaskedLM
+import unicodedata
+
+import numpy as np
+from transformers import BertTokenizer
 import torch
 
 import config
-from utils import split_by_maxlen
+import profiling
+from inference_backend import load_masked_lm
+from utils import split_by_maxlen, is_chinese_char
+from utils import dir_files, resource_version
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 unk_tokens = [' ', '“', '”', '‘', '’', '\n', '…', '—', '\t', '֍', '']
+# 字符编码表覆盖的码位(BMP)，超出范围的字符由分词器编码
+CHAR_TABLE_SIZE = 0x10000
+# 编码表中分词时丢弃的字符(空白)，需要分词器编码的字符
+CHAR_DROP = -1
+CHAR_SLOW = -2
+
+
+def is_isolated_char(char):
+    """
+    BERT分词时总是单独成词的字符：汉字、标点、空白，其编码与上下文无关
+    """
+    cp = ord(char)
+    if char in ' \t\n\r' or unicodedata.category(char) == 'Zs':
+        return True
+    if 0x4E00 <= cp <= 0x9FFF or 0x3400 <= cp <= 0x4DBF or 0xF900 <= cp <= 0xFAFF:
+        return True
+    if 33 <= cp <= 47 or 58 <= cp <= 64 or 91 <= cp <= 96 or 123 <= cp <= 126:
+        return True
+    return unicodedata.category(char).startswith('P')
 
 
 def get_errors(corrected_text, origin_text):
@@ -32,12 +56,127 @@ def get_errors(corrected_text, origin_text):
 
 
 class MacBertCorrector(object):
-    def __init__(self, macbert_model_dir=config.macbert_model_dir):
+    def __init__(self, macbert_model_dir=config.macbert_model_dir, max_batch_tokens=config.macbert_max_batch_tokens,
+                 backend=None):
+        """
+        :param macbert_model_dir: 模型目录
+        :param max_batch_tokens: 每个batch补齐后的最大token数
+        :param backend: 推理后端, 见inference_backend, 默认config.inference_backend
+        """
         super(MacBertCorrector, self).__init__()
         self.name = 'macbert_corrector'
         self.tokenizer = BertTokenizer.from_pretrained(macbert_model_dir)
-        self.model = BertForMaskedLM.from_pretrained(macbert_model_dir)
-        self.model.to(device)
+        # 在创建模型时才探测GPU，不在导入时初始化CUDA
+        self.model, self.backend = load_masked_lm(macbert_model_dir, backend)
+        self.device = self.model.device
+        # 每个batch补齐后的最大token数
+        self.max_batch_tokens = max_batch_tokens
+        # 模型版本号，用于结果缓存
+        self.resource_version = resource_version(dir_files(macbert_model_dir), self.backend)
+        self.special_ids = set(self.tokenizer.all_special_ids)
+        # 非特殊的单字token id -> 字符，预测结果都是单字时不调用tokenizer.decode
+        self.id_chars = {}
+        for token, token_id in self.tokenizer.get_vocab().items():
+            if len(token) == 1 and token != ' ' and token_id not in self.special_ids:
+                self.id_chars[token_id] = token
+        self.char_table, self.char_unaligned = self._build_char_table()
+
+    def get_resource_version(self):
+        return self.resource_version
+
+    def _build_char_table(self):
+        """
+        预计算字符 -> token id表，只收录单独成词且不受大小写、重音归一化影响的字符，
+        常用汉字直接查词表，其他字符由分词器夹在字母间逐字编码得到，最后用拼接后的文本校验与上下文无关
+        :return: (table, unaligned), table[码位]为token id, CHAR_DROP或CHAR_SLOW;
+                 unaligned[码位]为True时get_errors对unk_tokens的处理与分词结果不能逐字对齐
+        """
+        table = np.full(CHAR_TABLE_SIZE, CHAR_SLOW, dtype=np.int64)
+        unaligned = np.zeros(CHAR_TABLE_SIZE, dtype=bool)
+        chars = [chr(cp) for cp in range(CHAR_TABLE_SIZE)]
+        chars = [c for c in chars if is_isolated_char(c) and unicodedata.normalize('NFD', c) == c and c.lower() == c]
+        unk_id = self.tokenizer.unk_token_id
+        unk_chars = set(unk_tokens)
+        vocab = self.tokenizer.get_vocab()
+        for char in chars:
+            if is_chinese_char(char):
+                table[ord(char)] = vocab.get(char, unk_id)
+        # 分词器的unicode版本可能较旧，新增的标点不会与相邻字母分开
+        sentinel = self.tokenizer('a', add_special_tokens=False)['input_ids']
+        others = [c for c in chars if not is_chinese_char(c)]
+        samples = ['a%sa' % c for c in others]
+        encoded = self.tokenizer(samples, add_special_tokens=False, return_attention_mask=False,
+                                 return_token_type_ids=False)['input_ids']
+        for char, ids in zip(others, encoded):
+            if len(sentinel) != 1 or ids[:1] != sentinel or ids[-1:] != sentinel:
+                continue
+            ids = ids[1:-1]
+            if not ids:
+                table[ord(char)] = CHAR_DROP
+                unaligned[ord(char)] = char not in unk_chars
+            elif len(ids) == 1 and (ids[0] == unk_id or self.id_chars.get(ids[0]) == char):
+                table[ord(char)] = ids[0]
+                unaligned[ord(char)] = char in unk_chars
+        # 分词器不按字切分时不使用编码表
+        chars = [c for c in chars if table[ord(c)] != CHAR_SLOW]
+        samples = [''.join(chars[i:i + 64]) for i in range(0, len(chars), 64)]
+        encoded = self.tokenizer(samples, add_special_tokens=False, return_attention_mask=False,
+                                 return_token_type_ids=False)['input_ids']
+        for sample, ids in zip(samples, encoded):
+            if ids != [table[ord(c)] for c in sample if table[ord(c)] != CHAR_DROP]:
+                print('char table disabled, tokenizer does not split by char')
+                return None, None
+        return table, unaligned
+
+    def _encode(self, text):
+        """
+        用字符编码表编码短句
+        :return: (input_ids, kept), kept为各字符是否有对应token的bool数组, 不能与get_errors逐字对齐时为None;
+                 含编码表外的字符(字母、数字等)时返回(None, None), 由分词器编码
+        """
+        if self.char_table is None or not text:
+            return None, None
+        cps = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        if cps.max() >= CHAR_TABLE_SIZE:
+            return None, None
+        ids = self.char_table[cps]
+        if ids.min() == CHAR_SLOW:
+            return None, None
+        kept = ids != CHAR_DROP
+        input_ids = [self.tokenizer.cls_token_id] + ids[kept].tolist() + [self.tokenizer.sep_token_id]
+        return input_ids, None if self.char_unaligned[cps].any() else kept
+
+    def _decode(self, pred_ids):
+        """
+        与tokenizer.decode(pred_ids, skip_special_tokens=True).replace(' ', '')结果相同
+        """
+        chars = [self.id_chars.get(i) for i in pred_ids if i not in self.special_ids]
+        if None in chars:
+            return self.tokenizer.decode(pred_ids, skip_special_tokens=True).replace(' ', '')
+        return ''.join(chars)
+
+    def _compare_ids(self, text, input_ids, pred_ids, kept):
+        """
+        在token id上对比输入和预测，与get_errors(self._decode(pred_ids)[:len(text)], text)结果相同
+        只处理首尾预测为特殊token、其余预测都是单字的短句, 其他情况返回None
+        :param kept: 各字符是否有对应token, 无token的字符都在unk_tokens中
+        """
+        if len(pred_ids) != len(input_ids) or pred_ids[0] not in self.special_ids \
+                or pred_ids[-1] not in self.special_ids:
+            return None
+        if not all(i in self.id_chars for i in pred_ids[1:-1]):
+            return None
+        positions = np.flatnonzero(kept).tolist()
+        if not positions:
+            return '', []
+        # 最后一个token之后的空白不在纠正结果中
+        corrected = list(text[:positions[-1] + 1])
+        sub_details = []
+        for pos, input_id, pred_id in zip(positions, input_ids[1:-1], pred_ids[1:-1]):
+            if input_id != pred_id:
+                corrected[pos] = self.id_chars[pred_id]
+                sub_details.append((text[pos], corrected[pos], pos, pos + 1))
+        return ''.join(corrected), sub_details
 
     def correct(self, text):
         """
@@ -45,22 +184,76 @@ class MacBertCorrector(object):
         :param text: 句子文本
         :return: corrected_text, list[list], [error_word, correct_word, begin_pos, end_pos]
         """
-        text_new = ''
-        details = []
+        return self.correct_batch([text])[0]
+
+    @profiling.timed('macbert.correct_batch')
+    def correct_batch(self, texts, maxlen=128):
+        """
+        批量纠错：全部文本切分为短句后按token长度分桶，每桶补齐后不超过max_batch_tokens，
+        推理后按各文本的偏移拼接结果，与逐个调用correct结果一致
+        :param texts: list, 文本
+        :param maxlen: 短句最大长度
+        :return: list, [(corrected_text, details)]
+        """
         # 长句切分为短句
-        blocks = split_by_maxlen(text, maxlen=128)
-        blocks = [block[0] for block in blocks]
-        inputs = self.tokenizer(blocks, padding=True, return_tensors='pt').to(device)
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-
-        for ids, text in zip(outputs.logits, blocks):
-            decode_tokens = self.tokenizer.decode(torch.argmax(ids, dim=-1), skip_special_tokens=True).replace(' ', '')
-            corrected_text = decode_tokens[:len(text)]
-            corrected_text, sub_details = get_errors(corrected_text, text)
-            text_new += corrected_text
-            details.extend(sub_details)
-        return text_new, details
+        blocks = []
+        for text_idx, text in enumerate(texts):
+            for block, start_idx in split_by_maxlen(text, maxlen=maxlen):
+                blocks.append((text_idx, block, start_idx))
+        if not blocks:
+            return [('', []) for _ in texts]
+        with profiling.stage('macbert.encode'):
+            encoded = [self._encode(block) for _, block, _ in blocks]
+            slow = [i for i, (ids, _) in enumerate(encoded) if ids is None]
+            if slow:
+                for i, ids in zip(slow, self.tokenizer([blocks[i][1] for i in slow])['input_ids']):
+                    encoded[i] = (ids, None)
+        input_ids = [ids for ids, _ in encoded]
+        kept = [k for _, k in encoded]
+
+        # 按长度排序分桶
+        block_results = [None] * len(blocks)
+        bucket = []
+        for i in sorted(range(len(blocks)), key=lambda k: len(input_ids[k])):
+            if bucket and (len(bucket) + 1) * len(input_ids[i]) > self.max_batch_tokens:
+                self._correct_bucket(bucket, blocks, input_ids, kept, block_results)
+                bucket = []
+            bucket.append(i)
+        self._correct_bucket(bucket, blocks, input_ids, kept, block_results)
+
+        results = [('', []) for _ in texts]
+        for (text_idx, _, _), (corrected_text, sub_details) in zip(blocks, block_results):
+            text_new, details = results[text_idx]
+            results[text_idx] = (text_new + corrected_text, details + sub_details)
+        return results
+
+    def _correct_bucket(self, bucket, blocks, input_ids, kept, block_results):
+        lengths = [len(input_ids[i]) for i in bucket]
+        ids = np.full((len(bucket), max(lengths)), self.tokenizer.pad_token_id, dtype=np.int64)
+        for row, i in enumerate(bucket):
+            ids[row, :lengths[row]] = input_ids[i]
+        ids = torch.from_numpy(ids)
+        inputs = {
+            'input_ids': ids,
+            'attention_mask': (torch.arange(ids.shape[1]) < torch.tensor(lengths)[:, None]).long(),
+            'token_type_ids': torch.zeros_like(ids),
+        }
+        with torch.no_grad(), profiling.stage('macbert.forward'):
+            outputs = self.model(**{k: v.to(self.device) for k, v in inputs.items()})
+            pred_ids = torch.argmax(outputs.logits, dim=-1).tolist()
+        for i, pred, length in zip(bucket, pred_ids, lengths):
+            _, text, start_idx = blocks[i]
+            # 只解码真实token，补齐位置的预测与其他短句的长度有关
+            pred = pred[:length]
+            result = None
+            if kept[i] is not None:
+                result = self._compare_ids(text, input_ids[i], pred, kept[i])
+            if result is None:
+                result = get_errors(self._decode(pred)[:len(text)], text)
+            corrected_text, sub_details = result
+            sub_details = [(wrong, right, begin + start_idx, end + start_idx)
+                           for wrong, right, begin, end in sub_details]
+            block_results[i] = (corrected_text, sub_details)
 
 
 if __name__ == "__main__":
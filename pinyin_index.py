@@ -0,0 +1,336 @@
+import os
+import pickle
+import threading
+import time
+from collections.abc import Mapping
+
+import pypinyin
+
+import config
+from utils import file_signature
+
+INDEX_VERSION = 1
+# CJK统一汉字区0x4E00-0x9FA5, 共20902个汉字
+CJK_RANGE = (0x4e00, 0x9fa6)
+
+
+class SamePinyinWordIndex(object):
+    """
+    同音近邻词索引
+    以(拼音序列, 遮盖一个字后的词)为键，一次查找即取得词典中与该词只差一个常用字、且拼音相同的词，
+    等价于 known(edit_distance_word(word, char_set)) 中替换部分再按拼音过滤
+    """
+    mask = '\0'
+
+    def __init__(self, char_set=()):
+        self.char_set = frozenset(c for c in char_set if len(c) == 1)
+        # 非单字的常用字条目无法按位置建索引，查询时单独处理
+        self.multi_chars = frozenset(c for c in char_set if len(c) != 1)
+        self.index = {}
+        self.size = 0
+        # derive得到的叠加索引查找时合并基础索引的结果
+        self.base = None
+
+    def derive(self):
+        """
+        派生叠加索引，新增词只加入叠加索引，基础索引共享不复制
+        :return: SamePinyinWordIndex
+        """
+        index = SamePinyinWordIndex()
+        index.char_set = self.char_set
+        index.multi_chars = self.multi_chars
+        index.base = self
+        return index
+
+    @staticmethod
+    def get_pinyin(word):
+        return '\x01'.join(pypinyin.lazy_pinyin(word))
+
+    def _keys(self, word, pinyin):
+        for i, c in enumerate(word):
+            if c in self.char_set:
+                yield pinyin + '\t' + word[:i] + self.mask + word[i + 1:]
+
+    def add(self, word, pinyin=None):
+        """
+        加入词典词
+        :param word: str
+        :param pinyin: str, get_pinyin得到的拼音, 默认现算
+        :return:
+        """
+        if not word:
+            return
+        if pinyin is None:
+            pinyin = self.get_pinyin(word)
+        added = False
+        for key in self._keys(word, pinyin):
+            words = self.index.get(key)
+            if words is None:
+                # 多数键只对应一个词，直接存str节省内存
+                self.index[key] = word
+            elif isinstance(words, str):
+                if words == word:
+                    return
+                self.index[key] = [words, word]
+            elif word in words:
+                return
+            else:
+                words.append(word)
+            added = True
+        if added:
+            self.size += 1
+
+    def update(self, words):
+        for word in words:
+            self.add(word)
+
+    def __len__(self):
+        return self.size + (len(self.base) if self.base is not None else 0)
+
+    def get_replace_words(self, word, pinyin=None):
+        """
+        取与word只差一个常用字且拼音相同的词典词
+        :param word: str
+        :param pinyin: str, word的拼音, 默认现算
+        :return: set
+        """
+        if pinyin is None:
+            pinyin = self.get_pinyin(word)
+        result = self.base.get_replace_words(word, pinyin) if self.base is not None else set()
+        for i in range(len(word)):
+            words = self.index.get(pinyin + '\t' + word[:i] + self.mask + word[i + 1:])
+            if words is None:
+                continue
+            if isinstance(words, str):
+                result.add(words)
+            else:
+                result.update(words)
+        return result
+
+    def save(self, path, signature=None):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'version': INDEX_VERSION,
+                'pypinyin': pypinyin.__version__,
+                'signature': signature,
+                'char_set': self.char_set,
+                'multi_chars': self.multi_chars,
+                'index': self.index,
+                'size': self.size,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, signature=None):
+        """
+        加载索引缓存，版本或签名不一致时返回None
+        """
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            print('load index error, path: %s, %s' % (path, e))
+            return None
+        if data.get('version') != INDEX_VERSION or data.get('pypinyin') != pypinyin.__version__ \
+                or data.get('signature') != signature:
+            return None
+        index = cls()
+        index.char_set = data['char_set']
+        index.multi_chars = data['multi_chars']
+        index.index = data['index']
+        index.size = data['size']
+        return index
+
+    @classmethod
+    def build(cls, words, char_set):
+        index = cls(char_set)
+        index.update(words)
+        return index
+
+
+def load_same_pinyin_word_index(words, char_set, source_paths, path=config.same_pinyin_word_index_path):
+    """
+    取同音近邻词索引：缓存有效时直接加载，否则重新构建并写入缓存
+    :param words: 词典词
+    :param char_set: 常用字集合
+    :param source_paths: 构建索引所依赖的词典文件
+    :param path: 缓存文件路径
+    :return: SamePinyinWordIndex
+    """
+    signature = file_signature(source_paths)
+    index = SamePinyinWordIndex.load(path, signature)
+    if index is not None and index.char_set == frozenset(c for c in char_set if len(c) == 1):
+        return index
+    start = time.time()
+    index = SamePinyinWordIndex.build(words, char_set)
+    print('Built same pinyin word index, size: %d, time: %.2fs' % (len(index), time.time() - start))
+    if path:
+        try:
+            index.save(path, signature)
+        except OSError as e:
+            print('save index error, path: %s, %s' % (path, e))
+    return index
+
+
+class HomophoneIndex(object):
+    """
+    同音字索引：CJK统一汉字的 字->拼音 及 拼音->字，分不带声调(NORMAL)和带声调(TONE2, eg: zho1ng)两种
+    同一拼音下的字按码位排序
+    """
+    styles = {'normal': pypinyin.NORMAL, 'tone2': pypinyin.TONE2}
+
+    def __init__(self):
+        # {style: {char: pinyin}}
+        self.char_pinyin = {}
+        # {style: {pinyin: chars}}
+        self.pinyin_chars = {}
+
+    @classmethod
+    def build(cls):
+        index = cls()
+        chars = [chr(i) for i in range(*CJK_RANGE)]
+        for name, style in cls.styles.items():
+            # 以list传入时逐字注音，不做分词，结果与单字调用一致
+            pinyins = [item[0] for item in pypinyin.pinyin(chars, style=style)]
+            index.char_pinyin[name] = dict(zip(chars, pinyins))
+            groups = {}
+            for c, p in zip(chars, pinyins):
+                groups.setdefault(p, []).append(c)
+            index.pinyin_chars[name] = {p: ''.join(cs) for p, cs in groups.items()}
+        return index
+
+    def get_pinyin(self, char, tone=False):
+        """
+        取汉字拼音
+        :param char: str
+        :param tone: bool, 是否带声调(TONE2)
+        :return: str
+        """
+        name = 'tone2' if tone else 'normal'
+        p = self.char_pinyin[name].get(char)
+        if p is None:
+            p = pypinyin.pinyin(char, style=self.styles[name])[0][0]
+        return p
+
+    def get_chars(self, pinyin, tone=False):
+        """
+        取拼音对应的全部汉字
+        :param pinyin: str, 不带声调eg: zhong, 带声调eg: zho1ng
+        :param tone: bool, pinyin是否带声调(TONE2)
+        :return: str
+        """
+        return self.pinyin_chars['tone2' if tone else 'normal'].get(pinyin, '')
+
+    def get_homophones(self, char, tone=False):
+        """
+        取同音字，含该字本身
+        :param char: str
+        :param tone: bool, 是否要求声调相同
+        :return: str
+        """
+        return self.get_chars(self.get_pinyin(char, tone), tone)
+
+    def same_pinyin_dict(self):
+        """
+        同音字典视图，格式同LMCorrector.load_same_pinyin, 查询时才生成同音字集合
+        :return: Mapping, {char: set(同音字)}
+        """
+        return SamePinyinMapping(self)
+
+    def save(self, path):
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({
+                'version': INDEX_VERSION,
+                'pypinyin': pypinyin.__version__,
+                'char_pinyin': self.char_pinyin,
+                'pinyin_chars': self.pinyin_chars,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        加载索引缓存，版本或pypinyin版本不一致时返回None
+        """
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception as e:
+            print('load index error, path: %s, %s' % (path, e))
+            return None
+        if data.get('version') != INDEX_VERSION or data.get('pypinyin') != pypinyin.__version__:
+            return None
+        index = cls()
+        index.char_pinyin = data['char_pinyin']
+        index.pinyin_chars = data['pinyin_chars']
+        return index
+
+
+class SamePinyinMapping(Mapping):
+    """{char: set(不论声调的同音字，不含该字本身)}"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, char):
+        p = self.index.char_pinyin['normal'].get(char)
+        if p is None:
+            raise KeyError(char)
+        value = set(self.index.get_chars(p))
+        value.discard(char)
+        if not value:
+            raise KeyError(char)
+        return value
+
+    def __iter__(self):
+        for p, chars in self.index.pinyin_chars['normal'].items():
+            if len(chars) > 1:
+                yield from chars
+
+    def __len__(self):
+        return sum(len(chars) for chars in self.index.pinyin_chars['normal'].values() if len(chars) > 1)
+
+
+_homophone_index = None
+_homophone_index_lock = threading.Lock()
+
+
+def get_homophone_index(path=config.homophone_index_path):
+    """
+    取同音字索引，进程内只加载一次：缓存有效时直接加载，否则重新构建并写入缓存
+    :param path: 缓存文件路径
+    :return: HomophoneIndex
+    """
+    global _homophone_index
+    if _homophone_index is None:
+        with _homophone_index_lock:
+            if _homophone_index is None:
+                index = HomophoneIndex.load(path)
+                if index is None:
+                    start = time.time()
+                    index = HomophoneIndex.build()
+                    print('Built homophone index, time: %.2fs' % (time.time() - start))
+                    if path:
+                        try:
+                            index.save(path)
+                        except OSError as e:
+                            print('save index error, path: %s, %s' % (path, e))
+                _homophone_index = index
+    return _homophone_index
+
+
+if __name__ == "__main__":
+    # 离线构建同音近邻词索引及同音字索引缓存
+    from lm_corrector import LMCorrector
+
+    corrector = LMCorrector()
+    corrector.check_corrector_initialized()
+    print('index size: %d, path: %s' % (len(corrector.word_index), config.same_pinyin_word_index_path))
+    get_homophone_index()
+    print('homophone index path: %s' % config.homophone_index_path)
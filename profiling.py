@@ -0,0 +1,307 @@
+"""
+耗时统计
+
+按阶段记录耗时、调用次数及候选集大小，可在运行时开关，关闭时每次调用只多一次判断
+导出Prometheus文本格式的计数器和直方图，按采样率对请求做cProfile/pyinstrument剖析
+eg:
+    @profiling.timed('lm.generate_items')
+    def generate_items(...): ...
+
+    with profiling.stage('detect.tokenize'):
+        tokens = self.tokenizer.tokenize(sentence)
+
+    profiling.observe('lm.candidates', len(candidates))
+"""
+import bisect
+import functools
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import config
+
+# 耗时直方图的桶(秒)
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 数量直方图的桶
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+enabled = config.profiling_enabled
+sample_rate = config.profiling_sample_rate
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_stage_times = {}
+_sizes = {}
+_local = threading.local()
+# 最近的请求各阶段耗时
+recent_requests = deque(maxlen=config.profiling_recent_requests)
+
+
+def set_enabled(value, rate=None):
+    """
+    运行时开关
+    :param value: bool, 是否记录阶段耗时
+    :param rate: float, 剖析采样率, None不修改
+    """
+    global enabled, sample_rate
+    enabled = bool(value)
+    if rate is not None:
+        sample_rate = float(rate)
+
+
+def reset():
+    with _lock:
+        _stage_times.clear()
+        _sizes.clear()
+    recent_requests.clear()
+
+
+def _record(name, seconds):
+    with _lock:
+        histogram = _stage_times.get(name)
+        if histogram is None:
+            histogram = _stage_times[name] = Histogram(TIME_BUCKETS)
+        histogram.observe(seconds)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        item = trace.get(name)
+        if item is None:
+            trace[name] = [seconds, 1]
+        else:
+            item[0] += seconds
+            item[1] += 1
+
+
+def observe(name, value):
+    """
+    记录数量, eg: 候选集大小
+    """
+    if not enabled:
+        return
+    with _lock:
+        histogram = _sizes.get(name)
+        if histogram is None:
+            histogram = _sizes[name] = Histogram(SIZE_BUCKETS)
+        histogram.observe(value)
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        item = trace.setdefault('size:' + name, [0, 0])
+        item[0] += value
+        item[1] += 1
+
+
+class _Stage(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        _record(self.name, time.perf_counter() - self.start)
+
+
+class _NullStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+def stage(name):
+    """
+    阶段计时, with语句使用
+    :param name: 阶段名
+    """
+    return _Stage(name) if enabled else _null_stage
+
+
+def timed(name):
+    """
+    函数计时装饰器
+    :param name: 阶段名
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class request_scope(object):
+    """
+    汇总一次请求内各阶段的耗时、调用次数，结束后加入recent_requests
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.trace = None
+
+    def __enter__(self):
+        if enabled and getattr(_local, 'trace', None) is None:
+            self.trace = _local.trace = {}
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.trace is None:
+            return
+        _local.trace = None
+        total = time.perf_counter() - self.start
+        _record(self.name, total)
+        stages = {}
+        sizes = {}
+        for name, (value, count) in self.trace.items():
+            if name.startswith('size:'):
+                sizes[name[5:]] = {'sum': value, 'count': count}
+            else:
+                stages[name] = {'seconds': value, 'calls': count}
+        recent_requests.append({
+            'name': self.name,
+            'time': time.time(),
+            'seconds': total,
+            'stages': stages,
+            'sizes': sizes,
+            'thread': threading.current_thread().name,
+        })
+
+
+# 同一时刻只剖析一个请求: Python 3.12起cProfile不能同时启用多个实例, 并发采样到的请求不剖析
+_profile_lock = threading.Lock()
+
+
+class sampled_profile(object):
+    """
+    按采样率剖析当前线程，结果写入config.profiling_dump_dir
+    配置为pyinstrument且已安装时输出html, 否则输出cProfile的.prof文件
+    已有请求在剖析或其他剖析工具已启用时跳过
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.profiler = None
+        self.kind = None
+
+    def __enter__(self):
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return self
+        if not _profile_lock.acquire(blocking=False):
+            return self
+        if config.profiler == 'pyinstrument':
+            try:
+                import pyinstrument
+                self.profiler = pyinstrument.Profiler()
+                self.kind = 'pyinstrument'
+            except ImportError:
+                pass
+        if self.profiler is None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.kind = 'cprofile'
+        try:
+            self.profiler.enable() if self.kind == 'cprofile' else self.profiler.start()
+        except (ValueError, RuntimeError) as e:
+            # 进程中已有其他剖析工具(如调试器、外部cProfile)
+            print('profiling skipped, %s' % e)
+            self.profiler = None
+            _profile_lock.release()
+        return self
+
+    def __exit__(self, *args):
+        if self.profiler is None:
+            return
+        try:
+            if self.kind == 'cprofile':
+                self.profiler.disable()
+            else:
+                self.profiler.stop()
+            os.makedirs(config.profiling_dump_dir, exist_ok=True)
+            path = os.path.join(config.profiling_dump_dir, '%s_%s_%d_%d' % (
+                self.name, time.strftime('%Y%m%d%H%M%S'), os.getpid(), threading.get_ident()))
+            if self.kind == 'cprofile':
+                self.profiler.dump_stats(path + '.prof')
+            else:
+                with open(path + '.html', 'w', encoding='utf-8') as f:
+                    f.write(self.profiler.output_html())
+        finally:
+            self.profiler = None
+            _profile_lock.release()
+
+
+def _format_histogram(lines, metric, label, name, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append('%s_bucket{%s="%s",le="%s"} %d' % (metric, label, name, bound, cumulative))
+    lines.append('%s_bucket{%s="%s",le="+Inf"} %d' % (metric, label, name, histogram.count))
+    lines.append('%s_sum{%s="%s"} %r' % (metric, label, name, histogram.sum))
+    lines.append('%s_count{%s="%s"} %d' % (metric, label, name, histogram.count))
+
+
+def export_prometheus():
+    """
+    导出Prometheus文本格式
+    :return: str
+    """
+    with _lock:
+        stage_times = {name: _copy(h) for name, h in _stage_times.items()}
+        sizes = {name: _copy(h) for name, h in _sizes.items()}
+    lines = [
+        '# HELP cgec_profiling_enabled Whether stage timing is recorded.',
+        '# TYPE cgec_profiling_enabled gauge',
+        'cgec_profiling_enabled %d' % enabled,
+        '# HELP cgec_stage_seconds Wall time per stage.',
+        '# TYPE cgec_stage_seconds histogram',
+    ]
+    for name in sorted(stage_times):
+        _format_histogram(lines, 'cgec_stage_seconds', 'stage', name, stage_times[name])
+    lines.append('# HELP cgec_stage_calls_total Calls per stage.')
+    lines.append('# TYPE cgec_stage_calls_total counter')
+    for name in sorted(stage_times):
+        lines.append('cgec_stage_calls_total{stage="%s"} %d' % (name, stage_times[name].count))
+    lines.append('# HELP cgec_size Sizes such as candidate sets.')
+    lines.append('# TYPE cgec_size histogram')
+    for name in sorted(sizes):
+        _format_histogram(lines, 'cgec_size', 'name', name, sizes[name])
+    return '\n'.join(lines) + '\n'
+
+
+def _copy(histogram):
+    copied = Histogram(histogram.buckets)
+    copied.counts = list(histogram.counts)
+    copied.sum = histogram.sum
+    copied.count = histogram.count
+    return copied
@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+
+def make_key(algorithm, version, text, **kwargs):
+    """
+    缓存键：算法、资源版本、纠错参数及原文
+    原文不做会改变字符位置的归一化，否则缓存中的错误位置与原文对不上
+    """
+    raw = json.dumps([algorithm, version, sorted(kwargs.items()), text], ensure_ascii=False)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _loads(data):
+    corrected, details = json.loads(data)
+    return corrected, [tuple(detail) for detail in details]
+
+
+class ResultCache(object):
+    """
+    纠错结果缓存
+    一级为进程内LRU，按条数限制内存并支持TTL过期；
+    二级为可选的SQLite文件，多个worker进程共享命中，每写入purge_interval条清理一次，
+    删除过期条目，条数超过sqlite_max_rows时按写入先后删除最早的条目
+    """
+
+    def __init__(
+            self,
+            max_size=config.result_cache_size,
+            ttl=config.result_cache_ttl,
+            sqlite_path=config.result_cache_sqlite_path,
+            sqlite_max_rows=config.result_cache_sqlite_max_rows,
+            purge_interval=config.result_cache_purge_interval,
+    ):
+        """
+        :param max_size: 内存中最多缓存的条数
+        :param ttl: 过期秒数, 0或None不过期
+        :param sqlite_path: 共享缓存文件路径, 为空时只用内存缓存
+        :param sqlite_max_rows: 共享缓存最多保留的条数
+        :param purge_interval: 每写入多少条清理一次共享缓存
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path
+        self.sqlite_max_rows = sqlite_max_rows
+        self.purge_interval = purge_interval
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counts = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0,
+                        'sets': 0, 'evictions': 0, 'expired': 0, 'disk_purged': 0}
+        self._sets_since_purge = 0
+        if sqlite_path:
+            self._connect()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS result_cache '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expire_at REAL)')
+            self._local.conn = conn
+        return conn
+
+    def _expire_at(self):
+        return time.time() + self.ttl if self.ttl else None
+
+    def _count(self, name, n=1):
+        self._counts[name] += n
+
+    def get(self, key):
+        """
+        :param key: make_key得到的键
+        :return: (corrected_text, details) or None
+        """
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                expire_at, value = item
+                if expire_at is None or expire_at > now:
+                    self._items.move_to_end(key)
+                    self._count('hits')
+                    self._count('memory_hits')
+                    return value[0], list(value[1])
+                del self._items[key]
+                self._count('expired')
+        if self.sqlite_path:
+            try:
+                row = self._connect().execute(
+                    'SELECT value, expire_at FROM result_cache WHERE key = ?', (key,)).fetchone()
+            except sqlite3.Error as e:
+                print('result cache error, %s' % e)
+                row = None
+            if row is not None and (row[1] is None or row[1] > now):
+                value = _loads(row[0])
+                self._set_memory(key, value, row[1])
+                with self._lock:
+                    self._count('hits')
+                    self._count('disk_hits')
+                return value[0], list(value[1])
+        with self._lock:
+            self._count('misses')
+        return None
+
+    def _set_memory(self, key, value, expire_at):
+        with self._lock:
+            self._items[key] = (expire_at, (value[0], tuple(value[1])))
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._count('evictions')
+
+    def set(self, key, value):
+        """
+        :param key: make_key得到的键
+        :param value: (corrected_text, details)
+        """
+        expire_at = self._expire_at()
+        self._set_memory(key, value, expire_at)
+        with self._lock:
+            self._count('sets')
+            self._sets_since_purge += 1
+            purge = self._sets_since_purge >= self.purge_interval
+            if purge:
+                self._sets_since_purge = 0
+        if self.sqlite_path:
+            try:
+                self._connect().execute(
+                    'INSERT OR REPLACE INTO result_cache (key, value, expire_at) VALUES (?, ?, ?)',
+                    (key, _dumps(value), expire_at))
+                if purge:
+                    self.purge()
+            except sqlite3.Error as e:
+                print('result cache error, %s' % e)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+        if self.sqlite_path:
+            # 共享缓存不可用时只清空内存缓存，不影响重新加载
+            try:
+                self._connect().execute('DELETE FROM result_cache')
+            except sqlite3.Error as e:
+                print('result cache error, %s' % e)
+
+    def purge_expired(self):
+        """
+        删除共享缓存中的过期条目
+        :return: int, 删除的条数
+        """
+        if not self.sqlite_path:
+            return 0
+        return self._connect().execute('DELETE FROM result_cache WHERE expire_at < ?', (time.time(),)).rowcount
+
+    def purge(self):
+        """
+        清理共享缓存：删除过期条目，条数超过sqlite_max_rows时删除最早写入的条目
+        INSERT OR REPLACE会重新分配rowid，rowid越小写入越早
+        :return: int, 删除的条数
+        """
+        if not self.sqlite_path:
+            return 0
+        deleted = self.purge_expired()
+        if self.sqlite_max_rows:
+            deleted += self._connect().execute(
+                'DELETE FROM result_cache WHERE rowid <= '
+                '(SELECT rowid FROM result_cache ORDER BY rowid DESC LIMIT 1 OFFSET ?)',
+                (self.sqlite_max_rows,)).rowcount
+        with self._lock:
+            self._count('disk_purged', deleted)
+        return deleted
+
+    def stats(self):
+        """
+        命中率等统计
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats['size'] = len(self._items)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['max_size'] = self.max_size
+        stats['ttl'] = self.ttl
+        stats['sqlite_path'] = self.sqlite_path
+        stats['sqlite_max_rows'] = self.sqlite_max_rows
+        stats['pid'] = os.getpid()
+        return stats
+
+
+class CachedCorrector(object):
+    """
+    带结果缓存的纠错器，接口与被包装的纠错器一致
+    缓存键含纠错器的资源版本号，修改混淆集、词频后旧结果自动失效
+    """
+
+    def __init__(self, corrector, algorithm, cache):
+        self.corrector = corrector
+        self.algorithm = algorithm
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.corrector, name)
+
+    def for_tenant(self, tenant_id, **kwargs):
+        """
+        派生租户视图，与本纠错器共用缓存，租户词典文件计入资源版本号，缓存互不干扰
+        被包装的纠错器不支持租户词典时返回自身
+        """
+        if not hasattr(self.corrector, 'for_tenant'):
+            return self
+        return CachedCorrector(self.corrector.for_tenant(tenant_id, **kwargs), self.algorithm, self.cache)
+
+    def reloaded(self):
+        """重新加载被包装纠错器的词典，词典文件计入资源版本号，旧结果自动失效"""
+        return CachedCorrector(self.corrector.reloaded(), self.algorithm, self.cache)
+
+    def _version(self):
+        get_version = getattr(self.corrector, 'get_resource_version', None)
+        return get_version() if get_version else ''
+
+    def correct(self, text, **kwargs):
+        return self.correct_batch([text], **kwargs)[0]
+
+    def correct_batch(self, texts, **kwargs):
+        """
+        批量纠错，只对未命中缓存的文本调用纠错器，同一批内的重复文本只算一次
+        :param texts: list, 文本
+        :return: list, [(corrected_text, details)]
+        """
+        version = self._version()
+        keys = [make_key(self.algorithm, version, text, **kwargs) for text in texts]
+        results = [None] * len(texts)
+        missing = OrderedDict()
+        for i, key in enumerate(keys):
+            if key in missing:
+                missing[key].append(i)
+                continue
+            value = self.cache.get(key)
+            if value is None:
+                missing[key] = [i]
+            else:
+                results[i] = value
+        if missing:
+            computed = self.corrector.correct_batch([texts[idxs[0]] for idxs in missing.values()], **kwargs)
+            for (key, idxs), value in zip(missing.items(), computed):
+                self.cache.set(key, value)
+                for i in idxs:
+                    results[i] = value if i == idxs[0] else (value[0], list(value[1]))
+        return results
@@ -1,8 +1,10 @@
+import hashlib
+import math
 import random
 import re
-import pypinyin
-from jieba import posseg
-from pypinyin import pinyin
+import threading
+from collections import ChainMap
+
 import jieba
 import os
 
@@ -17,6 +19,39 @@ def to_unicode(text):
         raise ValueError("Unsupported string type: %s" % (type(text)))
 
 
+def file_signature(paths):
+    """
+    取文件签名(路径, 大小, 修改时间)，用于判断缓存是否过期
+    :param paths: list
+    :return: tuple
+    """
+    signature = []
+    for path in paths:
+        if path and os.path.exists(path):
+            stat = os.stat(path)
+            signature.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+        else:
+            signature.append((path, -1, -1))
+    return tuple(signature)
+
+
+def resource_version(paths, *extra):
+    """
+    资源版本号，由资源文件签名及运行期修改内容计算，资源变化后版本号随之变化
+    :param paths: list, 资源文件
+    :param extra: 运行期修改的内容，需可repr
+    :return: str
+    """
+    return hashlib.md5(repr((file_signature(paths),) + extra).encode('utf-8')).hexdigest()[:16]
+
+
+def dir_files(path):
+    """取目录下的文件，用于模型目录的签名"""
+    if not path or not os.path.isdir(path):
+        return [path]
+    return [os.path.join(path, name) for name in sorted(os.listdir(path))]
+
+
 # 判断字符类型：中文、英文、数字、其它
 def is_chinese_char(c):
     """判断字符c 是否为中文"""
@@ -66,22 +101,24 @@ def clean_text(text):
 
 
 # 取同音字
-def get_homophones_by_char(input_char):
-    """根据汉字取同音字"""
-    result = []
-    # CJK统一汉字区的范围是0x4E00-0x9FA5,即20902个汉字
-    for i in range(0x4e00, 0x9fa6):
-        if pinyin([chr(i)], style=pypinyin.NORMAL)[0][0] == pinyin(input_char, style=pypinyin.NORMAL)[0][0]:
-            result.append(chr(i))
-    return result
-def get_homophones_by_pinyin(input_pinyin):
-    """根据拼音取同音字"""
-    result = []
-    for i in range(0x4e00, 0x9fa6):
-        if pinyin([chr(i)], style=pypinyin.TONE2)[0][0] == input_pinyin:
-            # TONE2: 中zho1ng
-            result.append(chr(i))
-    return result
+def get_homophones_by_char(input_char, tone=False):
+    """
+    根据汉字取同音字，含该字本身，按码位排序
+    :param input_char: str
+    :param tone: bool, 是否要求声调相同
+    :return: list
+    """
+    from pinyin_index import get_homophone_index
+    return list(get_homophone_index().get_homophones(input_char, tone))
+def get_homophones_by_pinyin(input_pinyin, tone=True):
+    """
+    根据拼音取同音字
+    :param input_pinyin: str, 带声调(TONE2)eg: zho1ng, 不带声调eg: zhong
+    :param tone: bool, input_pinyin是否带声调
+    :return: list
+    """
+    from pinyin_index import get_homophone_index
+    return list(get_homophone_index().get_chars(input_pinyin, tone))
 
 
 def split_by_sym(text, include_symbol=True):
@@ -120,6 +157,18 @@ def split_by_maxlen(text, maxlen=512):
     return result
 
 
+def split_by_sentence(text):
+    """
+    文本切分为整句，以句末标点和换行切分，切分结果拼接后与原文一致
+    :param text: str
+    :return: list, (sentence, idx)
+    """
+    result = []
+    for match in re.finditer("[^。！？!?\n]*[。！？!?]+[”’\"'）)]*|[^。！？!?\n]+|\n+", text):
+        result.append((match.group(), match.start()))
+    return result
+
+
 def edit_distance_word(word, char_set):
     """
     all edits that are one edit away from 'word'
@@ -142,6 +191,8 @@ def segment(sentence, cut_type='word', pos=False):
     :return: list
     """
     if pos:
+        # 词性标注模型加载较慢，用到时才导入
+        from jieba import posseg
         if cut_type == 'word':
             word_pos_seq = posseg.lcut(sentence)
             word_seq, pos_seq = [], []
@@ -162,12 +213,119 @@ def segment(sentence, cut_type='word', pos=False):
         elif cut_type == 'char':
             return list(sentence)
 
+_base_tokenizers = {}
+_base_tokenizers_lock = threading.Lock()
+
+
+def get_base_tokenizer(dict_path=''):
+    """
+    取词典对应的jieba分词器，同一词典在进程内只构建一次前缀词典(jieba另有磁盘缓存)，只读共享
+    :param dict_path: 词典路径，不存在时用jieba默认词典
+    :return: jieba.Tokenizer
+    """
+    key = os.path.abspath(dict_path) if dict_path and os.path.exists(dict_path) else ''
+    with _base_tokenizers_lock:
+        tokenizer = _base_tokenizers.get(key)
+        if tokenizer is None:
+            tokenizer = jieba.Tokenizer(key) if key else jieba.Tokenizer()
+            tokenizer.initialize()
+            _base_tokenizers[key] = tokenizer
+    return tokenizer
+
+
+class _OverlayTokenizer(jieba.Tokenizer):
+    """
+    jieba分词器：共享基础词典的前缀词典，自定义词只写入本实例，不修改全局jieba及其他实例
+    派生的分词器链式引用上层的自定义词层，内存只随本层新增的词增长
+    """
+
+    def __init__(self, base, parent_layers=(), total=None):
+        """
+        :param base: 共享的jieba.Tokenizer
+        :param parent_layers: 上层分词器的自定义词层, 靠前的优先
+        :param total: 词频总和, 默认取base
+        """
+        super(_OverlayTokenizer, self).__init__()
+        self.dictionary = base.dictionary
+        self.base = base
+        self.base_freq = base.FREQ
+        self.extra_freq = {}
+        self.layers = [self.extra_freq] + list(parent_layers)
+        # add_word、suggest_freq等通过FREQ读写，写入落在本层的extra_freq
+        self.FREQ = ChainMap(*self.layers, self.base_freq)
+        self._getters = [layer.get for layer in self.layers] + [self.base_freq.get]
+        self.total = base.total if total is None else total
+        self.initialized = True
+
+    def derive(self):
+        """派生分词器，新词写入新的一层，本分词器的各层及基础前缀词典共享"""
+        return _OverlayTokenizer(self.base, self.layers, self.total)
+
+    def _freq(self, word):
+        for get in self._getters:
+            freq = get(word)
+            if freq is not None:
+                return freq
+        return None
+
+    def get_DAG(self, sentence):
+        # 同jieba.Tokenizer.get_DAG，逐层查词典，避免ChainMap的Python层查找
+        getters = self._getters
+        DAG = {}
+        N = len(sentence)
+        for k in range(N):
+            tmplist = []
+            i = k
+            frag = sentence[k]
+            while i < N:
+                for get in getters:
+                    freq = get(frag)
+                    if freq is not None:
+                        break
+                if freq is None:
+                    break
+                if freq:
+                    tmplist.append(i)
+                i += 1
+                frag = sentence[k:i + 1]
+            if not tmplist:
+                tmplist.append(k)
+            DAG[k] = tmplist
+        return DAG
+
+    def calc(self, sentence, DAG, route):
+        freq_of = self._freq
+        N = len(sentence)
+        route[N] = (0, 0)
+        logtotal = math.log(self.total)
+        for idx in range(N - 1, -1, -1):
+            best = None
+            for x in DAG[idx]:
+                candidate = (math.log(freq_of(sentence[idx:x + 1]) or 1) - logtotal + route[x + 1][0], x)
+                if best is None or candidate > best:
+                    best = candidate
+            route[idx] = best
+
+
 class Tokenizer(object):
-    def __init__(self, dict_path='', custom_word_freq_dict=None, custom_confusion_dict=None):
-        self.model = jieba
+    """
+    切词器，每个实例使用独立的jieba分词器，可在多线程中共用
+    """
+
+    def __init__(self, dict_path='', custom_word_freq_dict=None, custom_confusion_dict=None, model=None):
         # 初始化大词典
-        if os.path.exists(dict_path):
-            self.model.set_dictionary(dict_path)
+        self.model = model if model is not None else _OverlayTokenizer(get_base_tokenizer(dict_path))
+        self.add_words(custom_word_freq_dict, custom_confusion_dict)
+
+    def derive(self, custom_word_freq_dict=None, custom_confusion_dict=None):
+        """
+        派生切词器：在本切词器的自定义词上再加入新词，不影响本切词器
+        :return: Tokenizer
+        """
+        return Tokenizer(custom_word_freq_dict=custom_word_freq_dict, custom_confusion_dict=custom_confusion_dict,
+                         model=self.model.derive())
+
+    def add_words(self, custom_word_freq_dict=None, custom_confusion_dict=None):
         # 加载用户自定义词典
         if custom_word_freq_dict:
             for w, f in custom_word_freq_dict.items():
@@ -212,6 +370,89 @@ class Tokenizer(object):
         return result
 
 
+class WordTrie(object):
+    """
+    前缀树，编译词典后做前向最大匹配，耗时与句长线性相关，与词典大小无关
+    """
+    # 词结尾标记, 单字不会为空串
+    _end = ''
+
+    def __init__(self, words=()):
+        self.root = {}
+        self.size = 0
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if not word:
+            return
+        node = self.root
+        for c in word:
+            node = node.setdefault(c, {})
+        if self._end not in node:
+            node[self._end] = True
+            self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def longest_prefix(self, text, start=0):
+        """
+        取text[start:]开头的最长词
+        :param text: str
+        :param start: 起始位置
+        :return: int, 最长词的结束位置, 无匹配返回-1
+        """
+        end = -1
+        node = self.root
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                break
+            if self._end in node:
+                end = i + 1
+        return end
+
+    def fmm(self, text):
+        """
+        前向最大匹配
+        :param text: str
+        :return: (list, list), 各匹配词的起始位置及匹配词
+        """
+        idxs = []
+        result = []
+        index = 0
+        text_size = len(text)
+        while index < text_size:
+            end = self.longest_prefix(text, index)
+            if end > 0:
+                idxs.append(index)
+                result.append(text[index:end])
+                index = end
+            else:
+                index += 1
+        return idxs, result
+
+
+class OverlayWordTrie(WordTrie):
+    """
+    叠加在基础前缀树上的前缀树，新增词只存于本树，匹配时取两者中的最长词
+    """
+
+    def __init__(self, words=(), base=None):
+        super(OverlayWordTrie, self).__init__(words)
+        self.base = base
+
+    def __len__(self):
+        return self.size + (len(self.base) if self.base is not None else 0)
+
+    def longest_prefix(self, text, start=0):
+        end = super(OverlayWordTrie, self).longest_prefix(text, start)
+        if self.base is not None:
+            end = max(end, self.base.longest_prefix(text, start))
+        return end
+
+
 def find_difference(s1, s2):
     """找到 字符串s1 和 字符串s2 不同的字串"""
     # matches = []
@@ -281,7 +522,9 @@ def generate_error(sentence_lst):
         # 1. 单字近音错误
         if tp == 1:
             i = random.randint(0, len(sentence)-1)
-            generated = sentence.replace(sentence[i], get_homophones_by_char(sentence[i])[0])
+            # 只替换该位置的字，str.replace会替换全部相同的字
+            homophones = [c for c in get_homophones_by_char(sentence[i]) if c != sentence[i]]
+            generated = sentence[:i] + homophones[0] + sentence[i + 1:] if homophones else sentence
         else:
             generated = sentence
         # 2. 单字近形错误
@@ -299,4 +542,4 @@ if __name__ == "__main__":
     print(is_chinese_string('你hao'))
 
     sentence = '近日，中共中央、国务院、中央军委印发了《军队功勋荣誉表彰条例》'
-    generate_error(sentence)
+    print(generate_error([sentence]))